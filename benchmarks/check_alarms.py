@@ -0,0 +1,91 @@
+# Check the alarm index against a mocked controller that keeps a long alarm history, e.g.
+#   python benchmarks/check_alarms.py --history 50000
+# One alarm has been outstanding for a month, followed by `history` alarms that are all cleared.
+# The first read and every resync must only transfer the newest alarm and the alarms that are not cleared,
+# however old they are, and the active alarm metrics must follow raises, clears and resyncs.
+# Reports the alarms transferred by each read. Exits with 1 when a check fails.
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from smartzone_exporter import SmartZoneCollector
+from mock_smartzone import MockSmartZone
+
+
+def active(collector):
+    # (alarms active, alarms raised) summed over their labels
+    values = collections.Counter()
+    for family in collector.scrape(['alarms']):
+        for sample in family.samples:
+            values[sample.name] += sample.value
+    return values['smartzone_alarms_active'], values['smartzone_alarms_raised_total']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the alarm reads against a long alarm history')
+    parser.add_argument('--history', type=int, default=20000, help='Cleared alarms after the outstanding one '
+                                                                    '(default=20000)')
+    args = parser.parse_args()
+
+    mock = MockSmartZone(aps=10)
+    month = int(time.time() * 1000) - 30 * 86400 * 1000
+    outstanding = mock.raise_alarm(0, inserted=month)
+    for i in range(args.history):
+        mock.raise_alarm(i, cleared=True, inserted=month + 1000 * (i + 1))
+
+    # Alarm entries returned by the mocked alarm list
+    transferred = [0]
+    alert_page = mock.alert_page
+
+    def counting_alert_page(endpoint, criteria):
+        page = alert_page(endpoint, criteria)
+        transferred[0] += len(page['list'])
+        return page
+
+    mock.alert_page = counting_alert_page
+    url = mock.start()
+    collector = SmartZoneCollector(url, 'admin', 'admin', False, retry_backoff=0.01, alarm_resync=0.5)
+
+    failed = []
+
+    def read(name, expected_active, expected_raised, max_transferred):
+        transferred[0] = 0
+        values = active(collector)
+        print('{:<32} {:>7} alarms transferred, {:g} active, {:g} raised'.format(
+            name, transferred[0], values[0], values[1]))
+        if values != (expected_active, expected_raised):
+            failed.append('{}: {:g} active and {:g} raised, expected {} and {}'.format(
+                name, values[0], values[1], expected_active, expected_raised))
+        if transferred[0] > max_transferred:
+            failed.append('{}: {} alarms transferred, expected at most {}'.format(
+                name, transferred[0], max_transferred))
+
+    try:
+        # The newest alarm, and the outstanding one from the resync
+        read('first read', 1, 0, 2)
+        # Reads from the cursor get the newest alarm again, it is told apart by its id
+        read('no new alarms', 1, 0, 1)
+        mock.raise_alarm(1)
+        read('one new alarm', 2, 1, 2)
+        time.sleep(0.5)
+        mock.clear_alarm(outstanding)
+        # The new alarm from the cursor, and the new alarm again from the resync
+        read('resync after a clear', 1, 1, 2)
+        time.sleep(0.5)
+        read('resync without changes', 1, 1, 2)
+    finally:
+        collector.close()
+        mock.stop()
+
+    for failure in failed:
+        print('FAILED: {}'.format(failure))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
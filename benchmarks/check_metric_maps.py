@@ -0,0 +1,97 @@
+# Run every METRIC_MAPS entry against responses recorded with record_fixtures.py, e.g.
+#   python benchmarks/record_fixtures.py -u admin -p secret -t https://smartzone.example.com:8443 -o fixtures
+#   python benchmarks/check_metric_maps.py fixtures
+# Every map is run through add() and through record() with lazy families, which must give the same samples.
+# Reports the entities and samples of each map, and the metrics whose field no recorded entity has,
+# which usually means the API renamed or dropped it. Exits with 1 when a map fails or the two paths differ.
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from smartzone_exporter import METRIC_MAPS, SECTION_LISTS
+from mock_smartzone import fixture_name
+
+
+def load(directory, endpoint):
+    path = os.path.join(directory, fixture_name(endpoint))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def entities(directory):
+    # (section, [(entity, context)]) of every map whose fixture was recorded
+    for section, endpoint in SECTION_LISTS.items():
+        if section in METRIC_MAPS:
+            items = load(directory, endpoint)
+            if items is not None:
+                yield section, [(item, ()) for item in items]
+
+    statistics = load(directory, 'controller/{id}/statistics')
+    if statistics is not None:
+        # Each response is a list of samples, the collector uses the latest
+        yield 'system', [(response[0], [id]) for id, response in statistics.items() if response]
+
+    summary = load(directory, 'system/devicesSummary')
+    controllers = load(directory, 'controller')
+    if summary is not None and controllers:
+        yield 'system_summary', [(summary, [controllers[0]['id']])]
+
+    summaries = load(directory, 'aps/{mac}/operational/summary')
+    if summaries is not None:
+        yield 'ap_detail', [(summary, ()) for summary in summaries.values()]
+
+
+def samples(families):
+    return sorted((s.name, sorted(s.labels.items()), s.value) for family in families for s in family.samples)
+
+
+def check(section, items):
+    # Returns (samples, metrics never found, error)
+    metric_map = METRIC_MAPS[section]
+    families = metric_map.families()
+    records = []
+    try:
+        for entity, context in items:
+            metric_map.add(families, entity, context)
+            records.append(metric_map.record(entity, context))
+    except Exception as e:
+        return 0, [], '{!r}'.format(e)
+
+    added = samples(families.values())
+    if added != samples(metric_map.lazy(records)):
+        return len(added), [], 'add() and record() give different samples'
+    found = set(name for name, labels, value in added)
+    missing = [name for name in families if name not in found and name + '_total' not in found]
+    return len(added), missing, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the metric maps against recorded SmartZone responses')
+    parser.add_argument('fixtures', help='Fixture directory written by record_fixtures.py')
+    args = parser.parse_args()
+
+    failed = False
+    checked = set()
+    print('{:<16} {:>9} {:>9}  {}'.format('map', 'entities', 'samples', 'metrics without values'))
+    for section, items in entities(args.fixtures):
+        checked.add(section)
+        count, missing, error = check(section, items)
+        if error is not None:
+            failed = True
+            print('{:<16} {:>9} {:>9}  FAILED: {}'.format(section, len(items), count, error))
+        else:
+            print('{:<16} {:>9} {:>9}  {}'.format(section, len(items), count, ', '.join(missing) or '-'))
+    for section in METRIC_MAPS:
+        if section not in checked:
+            print('{:<16} no fixture recorded'.format(section))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Time and memory of parsing a large query/client response with each JSON parser
+# Reports wall time and the tracemalloc peak of parsing plus the VLAN aggregation, e.g.
+#   python benchmarks/client_parse_benchmark.py --clients 100000
+
+import argparse
+import collections
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import smartzone_exporter
+from smartzone_exporter import CLIENT_FIELDS, project, stream_page
+from mock_smartzone import MockSmartZone
+
+
+def aggregate(clients):
+    # Same aggregation as the smartzone_clients_per_vlan metric
+    totals = collections.Counter()
+    for client in clients:
+        vlan = client.get('vlan') or client.get('accessVlan')
+        if vlan is not None and client.get('zoneId') is not None:
+            totals[(str(client['zoneId']), str(vlan))] += 1
+    return totals
+
+
+def parse_text(body):
+    # What get_metrics() did before: decode to str, build every entry with all fields
+    return aggregate(json.loads(body.decode('utf-8'))['list'])
+
+
+def parse_json(body):
+    return aggregate(project(json.loads(body)['list'], CLIENT_FIELDS))
+
+
+def parse_orjson(body):
+    return aggregate(project(smartzone_exporter.orjson.loads(body)['list'], CLIENT_FIELDS))
+
+
+def parse_stream(body):
+    return aggregate(stream_page(io.BytesIO(body), CLIENT_FIELDS)['list'])
+
+
+def measure(parse, body):
+    start = time.perf_counter()
+    result = parse(body)
+    elapsed = time.perf_counter() - start
+    # Memory is measured in a second run, tracemalloc slows parsing down considerably
+    tracemalloc.start()
+    parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON parsing of the client list')
+    parser.add_argument('--clients', type=int, default=100000, help='Number of synthetic clients (default=100000)')
+    args = parser.parse_args()
+
+    mock = MockSmartZone(aps=1000, clients=args.clients)
+    body = json.dumps(mock.page('query/client', 0, args.clients)).encode()
+    print('{} clients, {:.1f} MB body'.format(args.clients, len(body) / 2 ** 20))
+
+    parsers = [('r.text + json', parse_text), ('bytes + json', parse_json)]
+    if smartzone_exporter.orjson is not None:
+        parsers.append(('orjson', parse_orjson))
+    if smartzone_exporter.ijson is not None:
+        parsers.append(('ijson stream', parse_stream))
+
+    print('{:<16} {:>9} {:>14}'.format('parser', 'seconds', 'peak MB'))
+    expected = None
+    for name, parse in parsers:
+        result, elapsed, peak = measure(parse, body)
+        if expected is None:
+            expected = result
+        elif result != expected:
+            print('{} produced different totals'.format(name))
+        print('{:<16} {:>9.2f} {:>14.1f}'.format(name, elapsed, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
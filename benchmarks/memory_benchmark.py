@@ -0,0 +1,129 @@
+# Measure the memory of complete scrapes against a mocked controller at several fleet sizes
+# Reports the RSS of the exporter before the first scrape, its peak while scraping and rendering the exposition,
+# and what stays resident while the last collection is kept like the --interval snapshot, e.g.
+#   python benchmarks/memory_benchmark.py --scales 1000,10000 \
+#       --baseline "$(git log --format=%h -1 --grep='AP sections in a compact table')~1"
+# --baseline runs the same scrapes with smartzone_exporter.py of another git revision, for a before/after table.
+# The example compares with the revision just before the AP sections were kept in a compact table.
+# Every scale and revision runs the exporter in a fresh process, so the figures are those of the exporter alone.
+
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mock_smartzone import MockSmartZone
+
+
+def rss_mib():
+    # Current RSS from /proc, and the peak from getrusage (kilobytes on Linux, bytes on macOS)
+    current = None
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 2 ** 10
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    return current, peak
+
+
+class Families():
+    # Registry-like wrapper for the exposition encoder
+
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return iter(self._families)
+
+
+def worker(args):
+    # Scrape, render and keep the families of the last scrape, then print one JSON line
+    if args.module_dir:
+        sys.path.insert(0, args.module_dir)
+    from smartzone_exporter import SmartZoneCollector
+    from prometheus_client.exposition import generate_latest
+
+    collector = SmartZoneCollector(args.worker, 'admin', 'admin', False, engine=args.engine,
+                                   ap_detail_mode=args.ap_detail_mode, retry_backoff=0.01)
+    gc.collect()
+    idle, _ = rss_mib()
+    families = None
+    size = 0
+    for i in range(args.scrapes):
+        # The previous collection is dropped first, like the poller replacing its snapshot
+        families = None
+        families = list(collector.scrape())
+        size = len(generate_latest(Families(families)))
+    gc.collect()
+    retained, peak = rss_mib()
+    print(json.dumps({'idle': idle, 'peak': peak, 'retained': retained, 'bytes': size}), flush=True)
+    collector.close()
+
+
+def run(url, args, module_dir):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', url, '--scrapes', str(args.scrapes),
+               '--engine', args.engine, '--ap-detail-mode', args.ap_detail_mode]
+    if module_dir:
+        command += ['--module-dir', module_dir]
+    output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads([line for line in output.splitlines() if line.startswith('{')][-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure exporter memory per scrape at several fleet sizes')
+    parser.add_argument('--scales', default='1000,5000,10000', help='Comma-separated AP counts (default=1000,5000,10000)')
+    parser.add_argument('--clients-per-ap', type=int, default=0, help='Mocked clients per AP (default=0)')
+    parser.add_argument('--scrapes', type=int, default=2, help='Scrapes per scale (default=2)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Collection engine (default=threads)')
+    parser.add_argument('--ap-detail-mode', choices=['per-ap', 'bulk', 'incremental'], default='per-ap',
+                        help='AP detail mode (default=per-ap)')
+    parser.add_argument('--baseline', metavar='REVISION',
+                        help='Also measure smartzone_exporter.py of this git revision, e.g. HEAD~1')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--module-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    revisions = [('current', None)]
+    directory = None
+    if args.baseline:
+        # The baseline module is extracted next to nothing else, the mock stays the current one
+        directory = tempfile.mkdtemp()
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+        source = subprocess.run(['git', 'show', '{}:smartzone_exporter.py'.format(args.baseline)], cwd=root,
+                                stdout=subprocess.PIPE, check=True).stdout
+        with open(os.path.join(directory, 'smartzone_exporter.py'), 'wb') as f:
+            f.write(source)
+        revisions.insert(0, (args.baseline, directory))
+
+    print('{:>12} {:>7} {:>9} {:>9} {:>9} {:>9} {:>13}'.format('revision', 'APs', 'idle MiB', 'peak MiB',
+                                                             'kept MiB', 'body MiB', 'peak/1k APs'))
+    try:
+        for aps in [int(scale) for scale in args.scales.split(',')]:
+            mock = MockSmartZone(aps=aps, clients=aps * args.clients_per_ap)
+            url = mock.start()
+            for name, module_dir in revisions:
+                result = run(url, args, module_dir)
+                print('{:>12} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>13.2f}'.format(
+                    name[:12], aps, result['idle'], result['peak'], result['retained'] or 0,
+                    result['bytes'] / 2 ** 20, (result['peak'] - result['idle']) / (aps / 1000)))
+            mock.stop()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+# Mock of the SmartZone northbound API (v12_0) used by the benchmarks
+# Entities are synthesized from their index, so large fleets cost no memory until a page is requested
+# Endpoints can instead be served from fixtures recorded on a real controller with record_fixtures.py,
+# and errors can be injected to exercise retries and fault isolation
+
+# Builtin JSON module to encode responses
+import json
+
+# Needed for simulated latency
+import time
+
+# argparse module used for providing command-line interface
+import argparse
+
+# Request counting and the server thread
+import collections
+import threading
+
+# Fixture files and error injection
+import os
+import random
+
+# Stdlib HTTP server, no third-party dependencies needed for the mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_PREFIX = '/wsg/api/public/v12_0/'
+SESSION_ID = 'mock-session'
+
+
+# Per-entity paths are counted and looked up under their template
+ENDPOINTS = ('controller', 'controller/{id}/statistics', 'system/devicesSummary', 'system/inventory', 'aps',
+             'aps/{mac}/operational/summary', 'aps/lineman', 'query/ap', 'query/wlan', 'query/client', 'domains',
+             'licenses', 'alert/alarm/list', 'alert/event/list')
+
+ALARM_SEVERITIES = ('Critical', 'Major', 'Minor', 'Warning')
+
+
+def fixture_name(endpoint):
+    # File of an endpoint in a fixture directory, e.g. aps/{mac}/operational/summary -> aps_mac_operational_summary.json
+    return endpoint.replace('{', '').replace('}', '').replace('/', '_') + '.json'
+
+
+def ap_mac(i):
+    return '00:11:22:{:02X}:{:02X}:{:02X}'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+class MockSmartZone():
+
+    def __init__(self, aps=100, clients=0, zones=4, latency=0.0, endpoint_latency=None, error_rate=0.0,
+                 error_status=503, drop_rate=0.0, error_endpoints=None, fixtures=None, seed=0, controllers=1,
+                 alarms=0, events=0):
+        self.aps = aps
+        self.clients = clients
+        self.zones = zones
+        # Seconds added to every response, plus extra seconds per endpoint template
+        self.latency = latency
+        self.endpoint_latency = endpoint_latency or {}
+        # Share of API requests answered with error_status, and share closed without any response
+        # Limited to the endpoint templates in error_endpoints when given, logins are never failed
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.error_endpoints = error_endpoints
+        self._random = random.Random(seed)
+
+        # Number of requests per endpoint, per-AP paths are counted under their template
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._server = None
+
+        # List endpoints as (entity count, entity factory)
+        self._lists = {
+            'controller': (controllers, self._controller),
+            'system/inventory': (zones, self._zone),
+            'aps': (aps, self._ap),
+            'aps/lineman': (aps, self._ap_lineman),
+            'query/ap': (aps, self._query_ap),
+            'query/wlan': (zones, self._wlan),
+            'query/client': (clients, self._client),
+            'domains': (1, self._domain),
+            'licenses': (2, self._license),
+        }
+        # Alert lists are held as entries, filtered by the time range and sorted like the query criteria ask
+        # raise_alarm(), clear_alarm() and add_events() change them while the mock runs
+        self._alerts = {'alert/alarm/list': [], 'alert/event/list': []}
+        # Synthesized alarms and events lie in the past, one per second
+        start = int(time.time() * 1000) - 1000 * (alarms + events)
+        for i in range(alarms):
+            self.raise_alarm(i % max(aps, 1), cleared=(i % 3 == 0), inserted=start + 1000 * i)
+        self.add_events(events, inserted=start + 1000 * alarms)
+        # Object endpoints, the factory gets the path parameter (AP MAC or controller id)
+        self._objects = {
+            'controller/{id}/statistics': self._statistics,
+            'system/devicesSummary': lambda id: self._devices_summary(),
+            'aps/{mac}/operational/summary': lambda mac: self._summary(mac, int(mac.replace(':', '')[6:], 16)),
+        }
+        if fixtures is not None:
+            self.load_fixtures(fixtures)
+
+    def load_fixtures(self, path):
+        # Serve the endpoints that have a file in `path` from it, the others stay synthesized
+        # List endpoints hold the list of all entities, per-entity endpoints an object keyed by MAC or id
+        for endpoint in ENDPOINTS:
+            name = os.path.join(path, fixture_name(endpoint))
+            if not os.path.exists(name):
+                continue
+            with open(name) as f:
+                data = json.load(f)
+            if endpoint in self._lists:
+                self._lists[endpoint] = (len(data), data.__getitem__)
+            elif endpoint in self._alerts:
+                self._alerts[endpoint] = data
+            elif '{' in endpoint:
+                # Unknown MACs or ids fall back to the synthesized response
+                synthesized = self._objects[endpoint]
+                self._objects[endpoint] = lambda key, data=data, synthesized=synthesized: (
+                    data[key] if key in data else synthesized(key))
+            else:
+                self._objects[endpoint] = lambda key, data=data: data
+        self.aps = self._lists['aps'][0]
+
+    def _controller(self, i):
+        return {'id': 'controller-{}'.format(i), 'model': 'vSZ-H', 'description': 'mock',
+                'serialNumber': 'SN{}'.format(i), 'clusterRole': 'Follower' if i else 'Leader', 'uptimeInSec': 86400,
+                'version': '7.0.0.0.100', 'apVersion': '7.0.0.0.100'}
+
+    def _zone(self, i):
+        return {'zoneId': 'zone-{}'.format(i), 'zoneName': 'Zone {}'.format(i), 'totalAPs': self.aps // self.zones,
+                'discoveryAPs': 0, 'connectedAPs': self.aps // self.zones, 'disconnectedAPs': 0,
+                'clients': self.clients // self.zones}
+
+    def _ap(self, i):
+        return {'mac': ap_mac(i), 'zoneId': 'zone-{}'.format(i % self.zones), 'apGroupId': 'group-0',
+                'name': 'AP-{}'.format(i), 'serial': '4{:011d}'.format(i)}
+
+    def _ap_lineman(self, i):
+        return {'mac': ap_mac(i), 'name': 'AP-{}'.format(i), 'location': 'Floor {}'.format(i % 10),
+                'configState': 'completed',
+                'alarms': {'criticalCount': 0, 'majorCount': i % 2, 'minorCount': 0, 'warningCount': 0}}
+
+    def _summary(self, mac, i):
+        return {'mac': mac, 'model': 'R750', 'version': '7.0.0.0.100', 'description': None,
+                'zoneId': 'zone-{}'.format(i % self.zones), 'connectionState': 'Connect',
+                'wifi24Channel': 1 + i % 11, 'wifi50Channel': 36, 'wifi6gChannel': 0,
+                'approvedTime': 1600000000000, 'lastSeenTime': 1700000000000, 'uptime': 3600 + i,
+                'clientCount': i % 30}
+
+    def _query_ap(self, i):
+        return {'apMac': ap_mac(i), 'deviceName': 'AP-{}'.format(i), 'model': 'R750',
+                'firmwareVersion': '7.0.0.0.100', 'description': None, 'zoneId': 'zone-{}'.format(i % self.zones),
+                'status': 'Online', 'channel24gValue': 1 + i % 11, 'channel50gValue': 36, 'channel6gValue': 0,
+                'lastSeen': 1700000000000, 'uptime': 3600 + i, 'numClients': i % 30,
+                'configurationStatus': 'Up-to-date', 'location': 'Floor {}'.format(i % 10)}
+
+    def _wlan(self, i):
+        return {'name': 'wlan-{}'.format(i), 'zoneId': 'zone-{}'.format(i), 'ssid': 'ssid-{}'.format(i),
+                'clients': self.clients // self.zones, 'traffic': 1000 * i, 'trafficUplink': 400 * i,
+                'trafficDownlink': 600 * i, 'vlan': 100 + i}
+
+    def _client(self, i):
+        client = {'clientMac': 'aa:bb:{:02x}:{:02x}:{:02x}:{:02x}'.format((i >> 24) & 0xff, (i >> 16) & 0xff,
+                                                                         (i >> 8) & 0xff, i & 0xff),
+                  'apMac': ap_mac(i % max(self.aps, 1)), 'zoneId': 'zone-{}'.format(i % self.zones),
+                  'ssid': 'ssid-{}'.format(i % self.zones), 'vlan': 100 + i % 8,
+                  'radioType': ('11ng', '11ac', '11ax-6G', '11ax')[i % 4], 'channel': (6, 36, 37, 149)[i % 4],
+                  'rssi': -40 - i % 45, 'snr': 10 + i % 40, 'txRatebps': 6000000 * (1 + i % 200),
+                  'txBytes': 1000 * i, 'rxBytes': 500 * i,
+                  'hostname': 'client-{}'.format(i), 'osType': 'Linux', 'authMethod': 'Standard'}
+        if i % 8 == 3:
+            # Newer releases also name the band, 802.11ax alone does not tell it
+            client['band'] = '5G'
+        return client
+
+    def _domain(self, i):
+        return {'id': 'domain-{}'.format(i), 'name': 'Domain {}'.format(i), 'domainType': 'REGULAR',
+                'parentDomainId': 'root', 'subDomainCount': 0, 'apCount': self.aps, 'zoneCount': self.zones}
+
+    def _license(self, i):
+        return {'name': 'CAPACITY-AP-{}'.format(i), 'description': 'AP capacity', 'count': self.aps,
+                'createTime': '2020-01-01', 'expireDate': '2030-01-01'}
+
+    def _statistics(self, controller_id):
+        port = {'rxBps': 1000.0, 'rxBytes': 10 ** 9, 'rxDropped': 0, 'rxPackets': 10 ** 6,
+                'txBps': 2000.0, 'txBytes': 2 * 10 ** 9, 'txDropped': 0, 'txPackets': 2 * 10 ** 6}
+        return [{'cpu': {'percent': 12.5}, 'disk': {'total': 100 * 2 ** 30, 'free': 60 * 2 ** 30},
+                 'memory': {'percent': 40.0}, 'control': port, 'port1': port, 'port2': port,
+                 'cluster': port, 'management': port}]
+
+    def _devices_summary(self):
+        return {'maxApOfCluster': 30000, 'totalRemainingApCapacity': 30000 - self.aps}
+
+    def _now(self, entries, inserted=None):
+        # Insertion times only go forward, one millisecond apart when entries are added faster than that
+        return max([inserted or int(time.time() * 1000)] + [entry['insertionTime'] + 1 for entry in entries[-1:]])
+
+    def raise_alarm(self, i, cleared=False, inserted=None):
+        # Alarm of AP i, inserted now or at `inserted` epoch milliseconds, returns its id
+        with self._lock:
+            alarms = self._alerts['alert/alarm/list']
+            alarm = {'id': 'alarm-{}'.format(len(alarms)), 'insertionTime': self._now(alarms, inserted),
+                     'severity': ALARM_SEVERITIES[len(alarms) % 4],
+                     'alarmState': 'Cleared' if cleared else 'Outstanding',
+                     'alarmType': 'AP disconnected', 'category': 'AP State Change', 'apMac': ap_mac(i),
+                     'zoneId': 'zone-{}'.format(i % self.zones)}
+            alarms.append(alarm)
+        return alarm['id']
+
+    def clear_alarm(self, id):
+        with self._lock:
+            for alarm in self._alerts['alert/alarm/list']:
+                if alarm['id'] == id:
+                    alarm['alarmState'] = 'Cleared'
+
+    def add_events(self, count, inserted=None):
+        # `count` events, one second apart from `inserted` epoch milliseconds on if given
+        with self._lock:
+            events = self._alerts['alert/event/list']
+            for i in range(count):
+                events.append({'id': 'event-{}'.format(len(events)),
+                               'insertionTime': self._now(events, inserted and inserted + 1000 * i),
+                               'severity': ('Informational', 'Major')[len(events) % 2],
+                               'category': ('AP Communication', 'Client')[len(events) % 2], 'activity': 'mock event'})
+
+    def alert_page(self, endpoint, criteria):
+        with self._lock:
+            entries = list(self._alerts[endpoint])
+        time_range = criteria.get('extraTimeRange')
+        if time_range:
+            entries = [e for e in entries if time_range['start'] <= e['insertionTime'] <= time_range['end']]
+        # Only the STATUS filter of the alarm list is understood, on alarmState
+        for key, keep in (('extraFilters', True), ('extraNotFilters', False)):
+            states = set(f['value'] for f in criteria.get(key) or () if f.get('type') == 'STATUS')
+            if states:
+                entries = [e for e in entries if (e.get('alarmState') in states) == keep]
+        if (criteria.get('sortInfo') or {}).get('dir') == 'DESC':
+            entries.reverse()
+        size = int(criteria.get('limit', 10))
+        index = (int(criteria.get('page', 1)) - 1) * size
+        end = min(index + size, len(entries))
+        return {'totalCount': len(entries), 'hasMore': end < len(entries), 'list': entries[index:end]}
+
+    def fault(self, endpoint):
+        # 'drop', 'error' or None for a request of `endpoint`
+        if self.error_endpoints is not None and endpoint not in self.error_endpoints:
+            return None
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.drop_rate:
+            return 'drop'
+        if draw < self.drop_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def page(self, endpoint, index, size):
+        count, factory = self._lists[endpoint]
+        end = min(index + size, count)
+        return {'totalCount': count, 'hasMore': end < count, 'firstIndex': index,
+                'list': [factory(i) for i in range(index, end)]}
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, avoid Nagle + delayed ACK stalls on keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, cookie=False, endpoint=None):
+                data = json.dumps(body).encode()
+                latency = mock.latency + mock.endpoint_latency.get(endpoint, 0)
+                if latency:
+                    time.sleep(latency)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json;charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                if cookie:
+                    self.send_header('Set-Cookie', 'JSESSIONID={}; Path=/'.format(SESSION_ID))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self, method):
+                url = urlparse(self.path)
+                if url.path == '/mock/requests':
+                    # Request counts since the last call, for benchmarks running the mock in another process
+                    with mock._lock:
+                        counts = dict(mock.requests)
+                        mock.requests.clear()
+                    return self._send(200, counts)
+                path = url.path[len(API_PREFIX):]
+                body = {}
+                if method == 'POST':
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length) or b'{}')
+
+                if path == 'session':
+                    mock.count('session')
+                    return self._send(200, {'controllerVersion': '7.0.0.0.100'}, cookie=(method == 'POST'))
+                if 'JSESSIONID={}'.format(SESSION_ID) not in (self.headers.get('Cookie') or ''):
+                    mock.count('unauthorized')
+                    return self._send(401, {'message': 'No active session'})
+
+                endpoint, key = path, None
+                if path.startswith('aps/') and path.endswith('/operational/summary'):
+                    endpoint, key = 'aps/{mac}/operational/summary', path.split('/')[1]
+                elif path.startswith('controller/') and path.endswith('/statistics'):
+                    endpoint, key = 'controller/{id}/statistics', path.split('/')[1]
+                mock.count(endpoint)
+
+                fault = mock.fault(endpoint)
+                if fault == 'drop':
+                    # Close the connection without a response, like a controller restarting its web service
+                    self.close_connection = True
+                    return
+                if fault == 'error':
+                    return self._send(mock.error_status, {'message': 'Injected error'}, endpoint=endpoint)
+
+                if endpoint in mock._objects:
+                    return self._send(200, mock._objects[endpoint](key), endpoint=endpoint)
+                if path in mock._alerts:
+                    return self._send(200, mock.alert_page(path, body), endpoint=endpoint)
+                if path in mock._lists:
+                    if method == 'POST':
+                        size = int(body.get('limit', 10))
+                        index = (int(body.get('page', 1)) - 1) * size
+                    else:
+                        query = parse_qs(url.query)
+                        size = int(query.get('listSize', ['100'])[0])
+                        index = int(query.get('index', ['0'])[0])
+                    return self._send(200, mock.page(path, index, size), endpoint=endpoint)
+                return self._send(404, {'message': 'Unknown resource {}'.format(path)})
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_POST(self):
+                self._route('POST')
+
+        return Handler
+
+    def start(self, port=0):
+        # Port 0 picks a free port, the base URL of the mock is returned
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock SmartZone API for exporter benchmarks')
+    parser.add_argument('--aps', type=int, default=100, help='Number of synthesized APs (default=100)')
+    parser.add_argument('--clients', type=int, default=0, help='Number of synthesized clients (default=0)')
+    parser.add_argument('--controllers', type=int, default=1, help='Number of cluster nodes (default=1)')
+    parser.add_argument('--alarms', type=int, default=0, help='Number of synthesized alarms (default=0)')
+    parser.add_argument('--events', type=int, default=0, help='Number of synthesized events (default=0)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response (default=0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of API requests answered with --error-status (default=0)')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of injected errors (default=503)')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Share of API requests closed without a response (default=0)')
+    parser.add_argument('--error-endpoint', action='append', metavar='ENDPOINT',
+                        help='Only inject errors on this endpoint template, can be repeated')
+    parser.add_argument('--fixtures', help='Directory of recorded responses, see record_fixtures.py')
+    parser.add_argument('--port', type=int, default=8443, help='Listening port (default=8443)')
+    args = parser.parse_args()
+
+    mock = MockSmartZone(aps=args.aps, clients=args.clients, controllers=args.controllers, alarms=args.alarms,
+                         events=args.events, latency=args.latency,
+                         error_rate=args.error_rate,
+                         error_status=args.error_status, drop_rate=args.drop_rate,
+                         error_endpoints=args.error_endpoint, fixtures=args.fixtures)
+    print('Mock SmartZone listening on {}'.format(mock.start(args.port)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Record responses of a real SmartZone controller as fixtures for mock_smartzone.py
+# List endpoints are stored as the list of all entities, per-entity endpoints keyed by AP MAC or controller id, e.g.
+#   python benchmarks/record_fixtures.py -u admin -p secret -t https://smartzone.example.com:8443 -o fixtures
+# The files hold names, MACs, serial numbers and locations of the recorded network, review them before sharing
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from smartzone_exporter import SmartZoneCollector
+from mock_smartzone import fixture_name
+
+# The event list is left out, controllers keep far too many events to record them all
+LIST_ENDPOINTS = ('controller', 'system/inventory', 'aps', 'aps/lineman', 'query/ap', 'query/wlan', 'query/client',
+                  'domains', 'licenses', 'alert/alarm/list')
+
+
+def fetch_all(collector, endpoint):
+    # Page through a list endpoint like the collector does, but keep every field of the entries
+    items = []
+    page = 0
+    while True:
+        method, kwargs = collector._page_request(endpoint, page)
+        result = collector._decode(collector._request(method, endpoint, **kwargs).content)
+        items.extend(result.get('list', []))
+        if not result.get('hasMore') or not result.get('list'):
+            return items
+        page += 1
+
+
+def write(directory, endpoint, data):
+    with open(os.path.join(directory, fixture_name(endpoint)), 'w') as f:
+        json.dump(data, f, indent=1)
+    print('{:<32} {}'.format(endpoint, len(data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record SmartZone API responses as mock fixtures')
+    parser.add_argument('-u', '--user', required=True, help='SmartZone API user')
+    parser.add_argument('-p', '--password', required=True, help='SmartZone API password')
+    parser.add_argument('-t', '--target', required=True, help='Target URL and port to access SmartZone')
+    parser.add_argument('--insecure', action='store_false', help='Allow insecure SSL connections to Smartzone')
+    parser.add_argument('-o', '--output', default='fixtures', help='Fixture directory (default=fixtures)')
+    parser.add_argument('--max-aps', type=int, default=100,
+                        help='Number of APs whose operational summary is recorded (default=100)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    collector = SmartZoneCollector(args.target, args.user, args.password, args.insecure, cache_ttls={})
+    try:
+        lists = {}
+        for endpoint in LIST_ENDPOINTS:
+            lists[endpoint] = fetch_all(collector, endpoint)
+            write(args.output, endpoint, lists[endpoint])
+
+        write(args.output, 'system/devicesSummary', collector.get_metrics('system/devicesSummary'))
+        write(args.output, 'controller/{id}/statistics',
+              {c['id']: collector.get_metrics('controller/{}/statistics'.format(c['id']))
+               for c in lists['controller']})
+        write(args.output, 'aps/{mac}/operational/summary',
+              {ap['mac']: collector.get_metrics('aps/{}/operational/summary'.format(ap['mac']))
+               for ap in lists['aps'][:args.max_aps]})
+    finally:
+        collector.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Benchmark complete scrapes against a mocked controller at several fleet sizes
+# Reports wall time, exporter CPU time, API requests and samples per scrape, and the peak RSS of the process, e.g.
+#   python benchmarks/scrape_benchmark.py --scales 100,1000,10000 --latency 0.002
+# Every scale runs the exporter in a fresh process, so peak RSS and CPU time are those of the exporter alone.
+# The peak RSS is the high-water mark of the process after each scrape, not the memory of that scrape: it never
+# goes down, and later scrapes only raise it when they need more than every scrape before them.
+# memory_benchmark.py measures what a scrape needs and keeps.
+# The mock runs in this process and reports its request counts over /mock/requests.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mock_smartzone import MockSmartZone
+
+
+def worker(args):
+    # Run the scrapes and print one JSON line per scrape
+    from smartzone_exporter import SmartZoneCollector
+
+    collector = SmartZoneCollector(args.worker, 'admin', 'admin', False, engine=args.engine,
+                                   ap_detail_mode=args.ap_detail_mode, json_parser=args.json_parser,
+                                   retry_backoff=0.01)
+    for i in range(args.scrapes):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        samples = sum(len(m.samples) for m in collector.scrape())
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        with urllib.request.urlopen(args.worker + '/mock/requests') as r:
+            requests = sum(json.loads(r.read()).values())
+        # Peak RSS of the process so far, ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss = peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+        print(json.dumps({'scrape': i + 1, 'seconds': wall, 'cpu': cpu, 'requests': requests, 'samples': samples,
+                          'peak_rss': peak_rss}), flush=True)
+    collector.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark complete scrapes at several fleet sizes')
+    parser.add_argument('--scales', default='100,1000,10000', help='Comma-separated AP counts (default=100,1000,10000)')
+    parser.add_argument('--clients-per-ap', type=int, default=10, help='Mocked clients per AP (default=10)')
+    parser.add_argument('--latency', type=float, default=0.002, help='Mock response latency in seconds (default=0.002)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of mocked API requests answered with HTTP 503 (default=0)')
+    parser.add_argument('--scrapes', type=int, default=3, help='Scrapes per scale (default=3)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Collection engine (default=threads)')
+    parser.add_argument('--ap-detail-mode', choices=['per-ap', 'bulk', 'incremental'], default='per-ap',
+                        help='AP detail mode (default=per-ap)')
+    parser.add_argument('--json-parser', choices=['auto', 'orjson', 'json', 'stream'], default='auto',
+                        help='JSON parser (default=auto)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    print('{:>7} {:>6} {:>9} {:>9} {:>9} {:>9} {:>17}'.format('APs', 'scrape', 'seconds', 'cpu', 'requests',
+                                                            'samples', 'process peak MiB'))
+    for aps in [int(scale) for scale in args.scales.split(',')]:
+        mock = MockSmartZone(aps=aps, clients=aps * args.clients_per_ap, latency=args.latency,
+                             error_rate=args.error_rate)
+        url = mock.start()
+        command = [sys.executable, os.path.abspath(__file__), '--worker', url, '--scrapes', str(args.scrapes),
+                   '--engine', args.engine, '--ap-detail-mode', args.ap_detail_mode,
+                   '--json-parser', args.json_parser]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        for line in process.stdout:
+            if not line.startswith('{'):
+                continue
+            result = json.loads(line)
+            print('{:>7} {:>6} {:>9.2f} {:>9.2f} {:>9} {:>9} {:>17.1f}'.format(
+                aps, result['scrape'], result['seconds'], result['cpu'], result['requests'], result['samples'],
+                result['peak_rss']))
+        process.wait()
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
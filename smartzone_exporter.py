@@ -4,6 +4,10 @@ import requests
 # Allow for silencing insecure warnings from requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+# Connection pooling for the long-lived API session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
 # Builtin JSON module for testing - might not need later
 import json
 
@@ -14,13 +18,1432 @@ import time
 import argparse
 
 # Prometheus modules for HTTP server & metrics
-from prometheus_client import start_http_server, Summary
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
-
-# Import Treading and queue
-import queue
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, HistogramMetricFamily, Metric, REGISTRY
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+# HTTP server for /metrics and /probe, and the multi-target config file
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import configparser
+
+# Pre-rendered expositions: gzip encoding and ETags
+import gzip
+import hashlib
+import functools
+
+# Import Treading
 import threading
 
+# Worker pool for concurrent page fetches, deque for the in-flight page window and Counter for aggregation
+import collections
+import concurrent.futures
+import itertools
+
+# Endpoint templates and the optional asyncio engine
+import re
+import asyncio
+
+# Picking the least recently refreshed APs in incremental AP detail mode
+import heapq
+import math
+
+# Histogram buckets of the client distributions
+import bisect
+
+# Interning of label values
+import sys
+
+# Field getters of the metric maps
+import operator
+
+# Protobuf encoding of remote_write requests
+import struct
+
+# Ring buffers of counter samples for the exporter-side rates
+import array
+
+# Snapshot state files written atomically for warm restarts
+import os
+import tempfile
+
+# aiohttp is only needed for --engine asyncio
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Optional JSON parsers: orjson parses response bytes faster, ijson parses incrementally from the socket
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# python-snappy is only needed to push with --push-format remote_write
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# AP detail fields from aps/{mac}/operational/summary and the query/ap field carrying the same value
+# Used by the bulk AP detail mode to build the per-AP metrics from paginated query/ap results
+BULK_AP_FIELDS = {
+    'mac': 'apMac',
+    'model': 'model',
+    'version': 'firmwareVersion',
+    'description': 'description',
+    'zoneId': 'zoneId',
+    'connectionState': 'status',
+    'wifi6gChannel': 'channel6gValue',
+    'wifi50Channel': 'channel50gValue',
+    'wifi24Channel': 'channel24gValue',
+    'lastSeenTime': 'lastSeen',
+    'uptime': 'uptime',
+    'clientCount': 'numClients',
+}
+
+# query/ap reports the AP status, translate it to the connectionState values of the per-AP summary
+BULK_AP_STATUS = {'Online': 'Connect', 'Offline': 'Disconnect'}
+
+# AP detail fields that query/ap does not return at all
+# They only change when an AP is (re-)approved, so they are fetched once per AP and remembered
+PER_AP_ONLY_FIELDS = ('approvedTime',)
+
+# query/ap fields compared between cycles in incremental AP detail mode
+# An AP is only fetched again when one of them changed; lastSeen is left out as it moves on every heartbeat
+AP_CHANGE_FIELDS = ('status', 'configurationStatus', 'firmwareVersion', 'model', 'zoneId', 'description',
+                    'channel24gValue', 'channel50gValue', 'channel6gValue')
+
+# Fields of the AP detail metrics, the only ones remembered of a summary in incremental mode
+AP_DETAIL_FIELDS = tuple(BULK_AP_FIELDS) + PER_AP_ONLY_FIELDS
+
+# Fast-moving detail fields copied from query/ap onto the remembered details of unchanged APs
+AP_LIVE_FIELDS = ('clientCount', 'lastSeenTime', 'uptime')
+
+
+# String-only AP families folded into smartzone_ap_info with --ap-info: family -> (label carrying the value,
+# smartzone_ap_info label), a None label means the value is already in ap_mac
+AP_INFO_FAMILIES = {
+    'smartzone_aps_list_ap_groupId': ('groupId', 'group_id'),
+    'smartzone_aps_list_ap_serial': ('serial', 'serial'),
+    'smartzone_ap_mac': ('mac', None),
+    'smartzone_ap_model': ('model', 'model'),
+    'smartzone_ap_version': ('version', 'version'),
+    'smartzone_ap_description': ('description', 'description'),
+    'smartzone_ap_zoneId': ('zoneId', 'zone_id'),
+    'smartzone_ap_connectionState': ('connectionState', 'connection_state'),
+    'smartzone_aps_location': ('location', 'location'),
+    'smartzone_aps_configState': ('configState', 'config_state'),
+}
+AP_INFO_LABELS = ('ap_mac', 'ap_name', 'zone_id', 'group_id', 'serial', 'model', 'version', 'description',
+                  'connection_state', 'location', 'config_state')
+
+
+def fold_ap_info(info, family):
+    # Add the values of an AP_INFO_FAMILIES family to the per-AP labels in `info`
+    source, label = AP_INFO_FAMILIES[family.name]
+    for sample in family.samples:
+        labels = info.setdefault(sample.labels['ap_mac'], {})
+        for name in ('ap_name', 'zone_id'):
+            if name in sample.labels:
+                labels[name] = sample.labels[name]
+        if label is not None:
+            labels[label] = sample.labels[source]
+
+
+# Fields of query/client entries used by the client metrics
+CLIENT_FIELDS = ('vlan', 'accessVlan', 'ssid', 'zoneId', 'apMac', 'band', 'radioType', 'rssi', 'snr', 'txRatebps')
+
+# Fields of the alarm and event list entries used by the alert metrics
+ALARM_FIELDS = ('id', 'insertionTime', 'severity', 'alarmState', 'zoneId', 'apMac')
+EVENT_FIELDS = ('id', 'insertionTime', 'severity', 'category')
+
+# List endpoints whose entries are reduced to the fields the metrics use while parsing
+LIST_FIELDS = {'query/client': CLIENT_FIELDS, 'alert/alarm/list': ALARM_FIELDS, 'alert/event/list': EVENT_FIELDS}
+
+
+def project(items, fields):
+    return [{f: item[f] for f in fields if f in item} for item in items]
+
+
+def stream_page(fp, fields):
+    # Incrementally parse a list page from a file object with ijson, keeping only `fields` of each entry
+    # Returns the page like json.loads would, the full entries are never built
+    result = {}
+    items = []
+    current = None
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if prefix == 'list.item':
+            if event == 'start_map':
+                current = {}
+            elif event == 'end_map':
+                items.append(current)
+                current = None
+        elif current is not None:
+            if prefix.startswith('list.item.') and prefix[10:] in fields:
+                current[prefix[10:]] = value
+        elif prefix in ('totalCount', 'hasMore', 'firstIndex'):
+            result[prefix] = value
+    result['list'] = items
+    return result
+
+
+# Per-entity API paths collapsed to a template, for per-endpoint settings and labels
+ENDPOINT_TEMPLATES = [
+    (re.compile(r'^aps/[^/]+/operational/summary$'), 'aps/{mac}/operational/summary'),
+    (re.compile(r'^controller/[^/]+/statistics$'), 'controller/{id}/statistics'),
+]
+
+
+def endpoint_name(api_path):
+    for pattern, name in ENDPOINT_TEMPLATES:
+        if pattern.match(api_path):
+            return name
+    return api_path
+
+
+def parse_endpoint_values(items):
+    # ENDPOINT=VALUE items, from repeated command line options or a comma-separated config value
+    result = {}
+    for item in items:
+        for pair in item.split(','):
+            if pair.strip():
+                endpoint, value = pair.rsplit('=', 1)
+                result[endpoint.strip()] = float(value)
+    return result
+
+
+# Sections of a collection, in the order they are collected
+# Each can be enabled per exporter or target, and selected per scrape with collect[]
+SECTIONS = ('controller', 'system', 'system_summary', 'inventory', 'aps', 'wlan', 'clients_vlan', 'clients',
+            'ap_detail', 'lineman', 'alarms', 'events', 'domains', 'licenses')
+
+# Sections that need data of another section, which is then collected without being exported
+# ap_detail only needs the AP list outside of bulk AP detail mode
+SECTION_DEPENDENCIES = {
+    'system': ('controller',),
+    'system_summary': ('controller',),
+    'ap_detail': ('aps',),
+}
+
+# List endpoint read by each section, fetched up front by the asyncio engine
+SECTION_LISTS = {
+    'controller': 'controller',
+    'inventory': 'system/inventory',
+    'aps': 'aps',
+    'wlan': 'query/wlan',
+    'clients_vlan': 'query/client',
+    'clients': 'query/client',
+    'lineman': 'aps/lineman',
+    'domains': 'domains',
+    'licenses': 'licenses',
+}
+
+
+# Sections collected by every replica of a sharded deployment, each for its own slice of the APs
+# The other, controller-wide sections are only collected by shard 0
+SHARDED_SECTIONS = ('aps', 'ap_detail', 'lineman')
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def shard_of(mac, count):
+    # Rendezvous hashing: every shard scores the AP and the highest score wins, so changing the shard count
+    # only moves the APs that an added shard wins or a removed shard held
+    mac = mac.lower()
+    return max(range(count),
+               key=lambda shard: hashlib.blake2b('{}/{}'.format(shard, mac).encode(), digest_size=8).digest())
+
+
+# Declarative metric mapping
+# Each section builds its metrics from the entities (list entries or single objects) of its endpoint,
+# as described by a MetricMap. Maps are compiled once at import into getters and label tuples,
+# so a collection only walks the entities, and adding a field is one MetricSpec entry.
+#   field    path of the value in the entity, dotted for nested objects ('alarms.criticalCount')
+#   name     metric name, specs with the same name share one family (e.g. the ports of system statistics)
+#   kind     'gauge', 'counter', or 'info' to export the value as the `info` label with a constant 1
+#   default  value used when the field is missing or null, None leaves the entity out of the metric
+#   const    constant labels, after the entity labels
+#   rename   renamed entity labels of this metric only
+MetricSpec = collections.namedtuple('MetricSpec', 'field name doc kind info default const rename')
+
+
+def gauge(field, name, doc, default=None, const=(), rename=None):
+    return MetricSpec(field, name, doc, 'gauge', None, default, tuple(const), rename or {})
+
+
+def counter(field, name, doc, default=None, const=()):
+    return MetricSpec(field, name, doc, 'counter', None, default, tuple(const), {})
+
+
+def info(field, name, doc, label=None, default=None):
+    # The info label is named after the field unless given
+    return MetricSpec(field, name, doc, 'info', label or field, default, (), {})
+
+
+def intern_label(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class MetricMap():
+
+    def __init__(self, metrics, labels=(), context=()):
+        # `labels` are (label, field) pairs read from every entity, a missing field fails the section
+        # `context` are labels whose values are passed to add(), like the controller id of statistics
+        self._families = collections.OrderedDict()
+        for spec in metrics:
+            names = tuple(context) + tuple(spec.rename.get(label, label) for label, field in labels)
+            names += tuple(label for label, value in spec.const)
+            if spec.info is not None:
+                names += (spec.info,)
+            if spec.name not in self._families:
+                kind = CounterMetricFamily if spec.kind == 'counter' else GaugeMetricFamily
+                self._families[spec.name] = (spec.name, spec.doc, kind, names)
+            elif self._families[spec.name][3] != names:
+                raise ValueError('Labels of {} differ between its specs'.format(spec.name))
+        # Every spec is reduced to a getter of its value, and to a function building its sample from a record,
+        # shared by add() and the lazy families
+        fixed = len(context) + len(labels)
+        self._label_fields = tuple(field for label, field in labels)
+        self._getters = tuple(self._getter(spec) for spec in metrics)
+        self._samplers = [(spec.name, self._sampler(spec, fixed + i, fixed)) for i, spec in enumerate(metrics)]
+
+    def _getter(self, spec):
+        # Value of the spec in an entity, with its default applied and as a string for info metrics
+        # None leaves the entity out of the metric
+        keys = spec.field.split('.')
+        default = spec.default
+        info = spec.info is not None
+        if len(keys) == 1 and default is None and not info:
+            return operator.methodcaller('get', spec.field)
+
+        def get(entity):
+            value = entity.get(keys[0])
+            for key in keys[1:]:
+                value = (value or {}).get(key)
+            if value is None:
+                value = default
+            if info and value is not None:
+                value = intern_label(str(value))
+            return value
+        return get
+
+    def _sampler(self, spec, position, fixed):
+        # Sample of the spec from a record, None when its value is missing
+        names = self._families[spec.name][3]
+        const = tuple(value for label, value in spec.const)
+        info = spec.info is not None
+        # Counter samples carry the _total suffix, like CounterMetricFamily.add_metric() adds it
+        sample_name = spec.name + '_total' if spec.kind == 'counter' else spec.name
+
+        if not const and not info:
+            # The label values are the first of the record, zip() stops after them
+            def sample(record):
+                value = record[position]
+                if value is not None:
+                    return Sample(sample_name, dict(zip(names, record)), value)
+            return sample
+
+        def sample(record):
+            value = record[position]
+            if value is None:
+                return None
+            if info:
+                # Export a dummy value for string-only metrics
+                return Sample(sample_name, dict(zip(names, record[:fixed] + const + (value,))), 1)
+            return Sample(sample_name, dict(zip(names, record[:fixed] + const)), value)
+        return sample
+
+    def record(self, entity, context=()):
+        # Reduce an entity to a tuple of its label values followed by the value of every spec (None when left out)
+        # Label values are interned, see SeriesBudget, and a missing label field raises KeyError
+        return (*context, *[intern_label(entity[field]) for field in self._label_fields],
+                *[get(entity) for get in self._getters])
+
+    def add(self, families, entity, context=()):
+        # Add the samples of an entity to the families of families()
+        record = self.record(entity, context)
+        for name, sample in self._samplers:
+            s = sample(record)
+            if s is not None:
+                families[name].samples.append(s)
+
+    def families(self):
+        # Empty families of one collection, keyed by metric name
+        return collections.OrderedDict((name, kind(name, doc, labels=labels))
+                                       for name, doc, kind, labels in self._families.values())
+
+    def build(self, entities, context=()):
+        families = self.families()
+        add = self.add
+        for entity in entities:
+            add(families, entity, context)
+        return families.values()
+
+    def lazy(self, records):
+        # Families whose samples are generated from `records` of record() every time they are read
+        # `records` may hold None for entities without a record, and is not changed afterwards
+        families = []
+        for name, doc, kind, labels in self._families.values():
+            family = kind(name, doc, labels=labels)
+            family.samples = LazySamples([sample for spec_name, sample in self._samplers if spec_name == name],
+                                         records)
+            families.append(family)
+        return families
+
+
+class LazySamples():
+    # Read-only sequence of the samples of a lazy MetricMap family, generated on every iteration
+    # so only the compact records stay in memory between collections
+    __slots__ = ('_samplers', '_records')
+
+    def __init__(self, samplers, records):
+        self._samplers = samplers
+        self._records = records
+
+    def __iter__(self):
+        for sample in self._samplers:
+            for record in self._records:
+                if record is not None:
+                    s = sample(record)
+                    if s is not None:
+                        yield s
+
+    def __len__(self):
+        return sum(1 for sample in self)
+
+    def __bool__(self):
+        return next(iter(self), None) is not None
+
+
+class APTable():
+    # Compact store of the AP sections of one collection
+    # Every AP gets one row, numbered in the order its MAC was first seen, and every AP section keeps the
+    # MetricMap records of its APs in a list indexed by that row. MACs are interned once for all sections.
+    __slots__ = ('index', 'macs', '_records')
+
+    def __init__(self):
+        self.index = {}
+        self.macs = []
+        self._records = {}
+
+    def add(self, section, mac, record):
+        row = self.index.get(mac)
+        if row is None:
+            mac = intern_label(mac)
+            row = self.index[mac] = len(self.macs)
+            self.macs.append(mac)
+        records = self._records.setdefault(section, [])
+        if len(records) <= row:
+            records.extend([None] * (row + 1 - len(records)))
+        records[row] = record
+
+    def records(self, section):
+        return self._records.setdefault(section, [])
+
+
+# Fields of each port in controller statistics
+SYSTEM_PORT_FIELDS = [
+    ('rxBps', 'rxBps (Throughput)'),
+    ('rxBytes', 'total rxBytes'),
+    ('rxDropped', 'total rxDropped'),
+    ('rxPackets', 'total rxPackets'),
+    ('txBps', 'txBps (Throughput)'),
+    ('txBytes', 'total txBytes'),
+    ('txDropped', 'total txDropped'),
+    ('txPackets', 'total txPackets'),
+]
+SYSTEM_PORTS = ('control', 'port1', 'port2', 'cluster', 'management')
+# Port statistics that are running totals rather than current values
+SYSTEM_PORT_COUNTERS = ('rxBytes', 'rxDropped', 'rxPackets', 'txBytes', 'txDropped', 'txPackets')
+
+# Metrics of each section, except clients_vlan and clients which aggregate the client list
+METRIC_MAPS = {
+    'controller': MetricMap(labels=[('id', 'id')], metrics=[
+        info('model', 'smartzone_controller_model', 'SmartZone controller model'),
+        info('description', 'smartzone_controller_description', 'SmartZone controller description'),
+        info('serialNumber', 'smartzone_controller_serial_number', 'SmartZone controller serial number'),
+        info('clusterRole', 'smartzone_controller_cluster_role', 'SmartZone controller cluster role',
+             label='serialNumber'),
+        counter('uptimeInSec', 'smartzone_controller_uptime_seconds', 'Controller uptime in sections'),
+        info('version', 'smartzone_controller_version', 'Controller version'),
+        info('apVersion', 'smartzone_controller_ap_firmware_version', 'Firmware version on controller APs'),
+    ]),
+    'system': MetricMap(context=['id'], metrics=[
+        gauge('cpu.percent', 'smartzone_system_cpu_usage', 'SmartZone system CPU usage'),
+        gauge('disk.total', 'smartzone_system_disk_size', 'SmartZone system disk size'),
+        gauge('disk.free', 'smartzone_system_disk_free', 'SmartZone system disk free space'),
+        gauge('memory.percent', 'smartzone_system_memory_usage', 'SmartZone system memory usage'),
+    ] + [
+        (counter if field in SYSTEM_PORT_COUNTERS else gauge)(
+            '{}.{}'.format(port, field), 'smartzone_system_port_' + field, 'SmartZone system port ' + doc,
+            const=[('port', port)])
+        for field, doc in SYSTEM_PORT_FIELDS for port in SYSTEM_PORTS
+    ]),
+    'system_summary': MetricMap(context=['id'], metrics=[
+        gauge('maxApOfCluster', 'smartzone_cluster_maxAPs',
+              'SmartZone Cluster number of maximum possible connected APs'),
+        gauge('totalRemainingApCapacity', 'smartzone_cluster_totalRemainingApCapacity',
+              'SmartZone Cluster number of total remaining possible connected APs'),
+    ]),
+    'inventory': MetricMap(labels=[('zone_name', 'zoneName'), ('zone_id', 'zoneId')], metrics=[
+        gauge('totalAPs', 'smartzone_zone_total_aps', 'Total number of APs in zone'),
+        gauge('discoveryAPs', 'smartzone_zone_discovery_aps', 'Number of zone APs in discovery state'),
+        gauge('connectedAPs', 'smartzone_zone_connected_aps', 'Number of connected zone APs'),
+        gauge('disconnectedAPs', 'smartzone_zone_disconnected_aps', 'Number of disconnected zone APs'),
+        gauge('clients', 'smartzone_zone_total_connected_clients', 'Total number of connected clients in zone'),
+    ]),
+    'aps': MetricMap(labels=[('zone_id', 'zoneId'), ('ap_name', 'name'), ('ap_mac', 'mac')], metrics=[
+        info('apGroupId', 'smartzone_aps_list_ap_groupId', 'SmartZone APs list ap groupId', label='groupId'),
+        info('serial', 'smartzone_aps_list_ap_serial', 'SmartZone APs list ap serial number'),
+    ]),
+    'wlan': MetricMap(labels=[('zoneId', 'zoneId'), ('name', 'name')], metrics=[
+        info('ssid', 'smartzone_wlan_ssid', 'SmartZone SSID', default=0),
+        gauge('clients', 'smartzone_wlan_clients', 'SmartZone WLAN clients', default=0),
+        # A missing traffic counter leaves the WLAN out rather than exporting a 0 that would look like a reset
+        counter('traffic', 'smartzone_wlan_traffic', 'SmartZone WLAN traffic'),
+        counter('trafficUplink', 'smartzone_wlan_traffic_uplink', 'SmartZone WLAN traffic Uplink'),
+        counter('trafficDownlink', 'smartzone_wlan_traffic_downlink', 'SmartZone WLAN traffic Downlink'),
+        gauge('vlan', 'smartzone_wlan_vlan', 'SmartZone WLAN vlan', default=0),
+    ]),
+    # Entities are AP details, from aps/{mac}/operational/summary or built from query/ap
+    'ap_detail': MetricMap(labels=[('ap_mac', 'mac')], metrics=[
+        info('mac', 'smartzone_ap_mac', 'SmartZone AP mac', default=0),
+        info('model', 'smartzone_ap_model', 'SmartZone AP model', default=0),
+        info('version', 'smartzone_ap_version', 'SmartZone AP version', default=0),
+        info('description', 'smartzone_ap_description', 'SmartZone AP description', default='None'),
+        info('zoneId', 'smartzone_ap_zoneId', 'SmartZone AP zone id', default=0),
+        info('connectionState', 'smartzone_ap_connectionState', 'SmartZone AP connection state', default=0),
+        gauge('wifi6gChannel', 'smartzone_ap_wifi6gChannel', 'SmartZone AP 6GHz channel number', default=0),
+        gauge('wifi50Channel', 'smartzone_ap_wifi50Channel', 'SmartZone AP 5GHz channel number', default=0),
+        gauge('wifi24Channel', 'smartzone_ap_wifi24Channel', 'SmartZone AP 2.4GHz channel number', default=0),
+        gauge('approvedTime', 'smartzone_ap_approvedTime', 'SmartZone AP approved time', default=0),
+        gauge('lastSeenTime', 'smartzone_ap_lastSeenTime', 'SmartZone AP last seen time', default=0),
+        gauge('uptime', 'smartzone_ap_uptime', 'SmartZone AP uptime', default=0, rename={'ap_mac': 'mac'}),
+        gauge('clientCount', 'smartzone_ap_clientCount', 'SmartZone AP client count', default=0),
+    ]),
+    'lineman': MetricMap(labels=[('ap_name', 'name'), ('ap_mac', 'mac')], metrics=[
+        info('location', 'smartzone_aps_location', 'SmartZone AP location'),
+        info('configState', 'smartzone_aps_configState', 'SmartZone AP configState'),
+        gauge('alarms.criticalCount', 'smartzone_aps_alarms_criticalCount', 'SmartZone AP criticalCount alarm'),
+        gauge('alarms.majorCount', 'smartzone_aps_alarms_majorCount', 'SmartZone majorCount alarms'),
+        gauge('alarms.minorCount', 'smartzone_aps_alarms_minorCount', 'SmartZone AP minorCount alarms'),
+        gauge('alarms.warningCount', 'smartzone_aps_alarms_warningCount', 'SmartZone AP warningCount alarm'),
+    ]),
+    'domains': MetricMap(labels=[('domain_id', 'id'), ('domain_name', 'name')], metrics=[
+        info('domainType', 'smartzone_domain_type', 'SmartZone Domain name'),
+        info('parentDomainId', 'smartzone_domain_parentDomainId', 'SmartZone Domain parent domain ID'),
+        gauge('subDomainCount', 'smartzone_domain_subDomainCount', 'SmartZone Domain sub domain numbers'),
+        gauge('apCount', 'smartzone_domain_apCount', 'SmartZone Domain total count of APs'),
+        gauge('zoneCount', 'smartzone_domain_zoneCount', 'SmartZone Domain count of zones'),
+    ]),
+    'licenses': MetricMap(labels=[('license_name', 'name')], metrics=[
+        info('description', 'smartzone_license_description', 'SmartZone License description'),
+        gauge('count', 'smartzone_license_count', 'SmartZone License count'),
+        info('createTime', 'smartzone_license_createTime', 'SmartZone License created date'),
+        info('expireDate', 'smartzone_license_expireDate', 'SmartZone License expire date'),
+    ]),
+}
+
+
+# Histogram buckets of the client distributions, per zone
+CLIENT_RSSI_BUCKETS = (-90, -85, -80, -75, -70, -67, -65, -60, -50)
+CLIENT_SNR_BUCKETS = (5, 10, 15, 20, 25, 30, 40, 50)
+# txRatebps is the PHY rate of the link to a client, not its throughput
+CLIENT_LINK_RATE_BUCKETS = (1e6, 6e6, 24e6, 54e6, 150e6, 300e6, 600e6, 1.2e9, 2.4e9)
+
+# JSON numbers, but not booleans or numeric strings
+NUMBER_TYPES = (int, float)
+
+
+# Radio types that only exist on one band, 802.11n, 802.11ax and 802.11be run on several
+RADIO_TYPE_BANDS = {'11b': '2.4GHz', '11g': '2.4GHz', '11ng': '2.4GHz', '11a': '5GHz', '11na': '5GHz', '11ac': '5GHz'}
+
+
+def client_band(band, radio_type):
+    # The band field of the client record when the controller sends one, e.g. '5G' or '6GHz',
+    # otherwise a radio type that names its band, like '11ax-6G'
+    # Channel numbers are not used, 6 GHz channels overlap those of the other bands
+    match = re.match(r'\s*(2\.4|5|6)\s*g', str(band or ''), re.IGNORECASE)
+    if match is not None:
+        return match.group(1) + 'GHz'
+    radio_type = str(radio_type or '')
+    match = re.search(r'-(2\.4|5|6)g', radio_type, re.IGNORECASE)
+    if match is not None:
+        return match.group(1) + 'GHz'
+    return RADIO_TYPE_BANDS.get(radio_type.lower(), 'unknown')
+
+
+class ClientHistogram():
+    # Fixed-bucket histogram per label value, so memory grows with the zones and not the clients
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # Label value -> bucket counts, followed by the sum of the observations
+        self._counts = {}
+
+    def observe(self, key, value):
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self._buckets) + 2)
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        counts[-1] += value
+
+    def family(self, name, doc, label):
+        family = HistogramMetricFamily(name, doc, labels=[label])
+        bounds = [floatToGoString(bound) for bound in self._buckets + (float('inf'),)]
+        # The samples are added directly: add_metric() leaves out _count and _sum when a bucket bound is negative,
+        # which all RSSI bounds are
+        samples = family.samples
+        for key, counts in self._counts.items():
+            key = intern_label(key)
+            for bound, count in zip(bounds, itertools.accumulate(counts[:-1])):
+                samples.append(Sample(name + '_bucket', {label: key, 'le': bound}, count))
+            samples.append(Sample(name + '_count', {label: key}, count))
+            samples.append(Sample(name + '_sum', {label: key}, counts[-1]))
+        return family
+
+
+class ClientAggregator():
+    # Aggregates the client list in one streaming pass, for both client sections
+    # Only counters and fixed-size histograms are kept, the clients themselves are dropped as they are read
+
+    def __init__(self, vlans=True, distributions=True):
+        self._vlans = vlans
+        self._distributions = distributions
+        self._bands = {}
+        self.vlan_totals = collections.Counter()
+        self.vlan_ssid_totals = collections.Counter()
+        self.ap_totals = collections.Counter()
+        self.band_totals = collections.Counter()
+        self.ssid_totals = collections.Counter()
+        self.rssi = ClientHistogram(CLIENT_RSSI_BUCKETS)
+        self.snr = ClientHistogram(CLIENT_SNR_BUCKETS)
+        self.link_rate = ClientHistogram(CLIENT_LINK_RATE_BUCKETS)
+
+    def add(self, client):
+        get = client.get
+        zone_id = get('zoneId')
+        if zone_id is None:
+            return
+        zone_id = str(zone_id)
+        ssid = get('ssid')
+        if self._vlans:
+            vlan = get('vlan') or get('accessVlan')
+            if vlan is not None:
+                vlan = str(vlan)
+                self.vlan_totals[(zone_id, vlan)] += 1
+                if ssid:
+                    self.vlan_ssid_totals[(zone_id, vlan, ssid)] += 1
+        if self._distributions:
+            ap_mac = get('apMac')
+            if ap_mac:
+                self.ap_totals[(zone_id, ap_mac)] += 1
+            # Few band and radio type combinations exist, their band label is only worked out once
+            radio = (get('band'), get('radioType'))
+            band = self._bands.get(radio)
+            if band is None:
+                band = self._bands[radio] = client_band(*radio)
+            self.band_totals[(zone_id, band)] += 1
+            if ssid:
+                self.ssid_totals[(zone_id, ssid)] += 1
+            value = get('rssi')
+            if type(value) in NUMBER_TYPES:
+                self.rssi.observe(zone_id, value)
+            value = get('snr')
+            if type(value) in NUMBER_TYPES:
+                self.snr.observe(zone_id, value)
+            value = get('txRatebps')
+            if type(value) in NUMBER_TYPES:
+                self.link_rate.observe(zone_id, value)
+
+    def vlan_families(self):
+        # Define metrics for client vlan membership (for WLANs with dynamic vlan assignment)
+        vlan_totals_metric = GaugeMetricFamily('smartzone_clients_per_vlan',
+                                               'Total number of clients on each VLAN',
+                                               labels=["zone_id", "vlan_id"])
+        vlan_ssid_metric = GaugeMetricFamily('smartzone_clients_per_vlan_ssid',
+                                             'Total number of clients on each VLAN per SSID',
+                                             labels=["zone_id", "vlan_id", "ssid"])
+        for (zone_id, vlan_id), total in self.vlan_totals.items():
+            vlan_totals_metric.add_metric([intern_label(zone_id), intern_label(vlan_id)], total)
+        for (zone_id, vlan_id, ssid), count in self.vlan_ssid_totals.items():
+            vlan_ssid_metric.add_metric([intern_label(zone_id), intern_label(vlan_id), intern_label(ssid)], count)
+        return [vlan_totals_metric, vlan_ssid_metric]
+
+    def distribution_families(self):
+        families = []
+        for name, doc, label, totals in (
+                ('smartzone_clients_per_ap', 'Number of clients associated to each AP', 'ap_mac', self.ap_totals),
+                ('smartzone_clients_per_band', 'Number of clients on each radio band', 'band', self.band_totals),
+                ('smartzone_clients_per_ssid', 'Number of clients on each SSID', 'ssid', self.ssid_totals)):
+            family = GaugeMetricFamily(name, doc, labels=['zone_id', label])
+            for (zone_id, value), count in totals.items():
+                family.add_metric([intern_label(zone_id), intern_label(value)], count)
+            families.append(family)
+        families.append(self.rssi.family('smartzone_client_rssi_dbm', 'RSSI of the clients in each zone', 'zone_id'))
+        families.append(self.snr.family('smartzone_client_snr_db', 'SNR of the clients in each zone', 'zone_id'))
+        families.append(self.link_rate.family('smartzone_client_link_rate_bps',
+                                              'PHY link rate to the clients in each zone', 'zone_id'))
+        return families
+
+
+# Alarms and events are read incrementally, oldest first from the insertionTime of the newest entry seen
+ALERT_ASCENDING = {'sortInfo': {'sortColumn': 'insertionTime', 'dir': 'ASC'}}
+ALERT_LATEST = {'sortInfo': {'sortColumn': 'insertionTime', 'dir': 'DESC'}, 'limit': 1}
+# Alarms that are not cleared, newest first, whenever they were raised
+ALARMS_NOT_CLEARED = {'sortInfo': {'sortColumn': 'insertionTime', 'dir': 'DESC'},
+                      'extraNotFilters': [{'type': 'STATUS', 'value': 'Cleared'}]}
+
+
+def alert_criteria(start):
+    # Query criteria of the alarms or events inserted since `start`, in epoch milliseconds
+    # The range ends now, entries stamped later by a controller clock ahead of ours are read next time
+    end = max(int(time.time() * 1000), start)
+    return dict(ALERT_ASCENDING, extraTimeRange={'start': start, 'end': end, 'interval': end - start})
+
+
+class AlertCursor():
+    # Position in an alert list: the newest insertionTime seen, and the ids seen with it
+    # Reads start at the position itself, entries of that millisecond are told apart by their id
+
+    def __init__(self, position=None, ids=()):
+        self.position = position
+        self._ids = set(ids)
+
+    def advance(self, entry):
+        # Whether the entry is newer than the cursor, which then moves past it
+        inserted = entry.get('insertionTime')
+        if type(inserted) not in NUMBER_TYPES:
+            return False
+        if self.position is not None:
+            if inserted < self.position or (inserted == self.position and entry.get('id') in self._ids):
+                return False
+        if self.position is None or inserted > self.position:
+            self.position = inserted
+            self._ids = set()
+        self._ids.add(entry.get('id'))
+        return True
+
+    def state(self):
+        return [self.position, list(self._ids)]
+
+
+class AlarmIndex():
+    # Alarms that are not cleared, keyed by id and bounded to `size` by forgetting the oldest
+    # New alarms are read from the cursor on every collection, from the newest alarm at the first read on.
+    # Acknowledgements and clears do not change an alarm's insertion time, so every `resync` seconds the index
+    # is replaced by the alarms the controller reports as not cleared, filtered by state and not by time
+
+    def __init__(self, size, resync, evicted):
+        self.size = size
+        self._resync = resync
+        self._evicted = evicted
+        # id -> (insertionTime, severity, alarmState, zone id, AP MAC), oldest first
+        self._alarms = collections.OrderedDict()
+        self.cursor = AlertCursor()
+        # Severity -> alarms raised since the first read
+        self.raised = collections.Counter()
+        self._synced_at = None
+
+    def start(self, latest):
+        # Position the cursor at the newest alarm, older alarms only enter the index through resync()
+        if latest:
+            self.cursor.advance(latest[0])
+        else:
+            self.cursor.position = 0
+
+    def resync_due(self):
+        return self._synced_at is None or time.monotonic() - self._synced_at >= self._resync
+
+    def _add(self, index, alarm, severity):
+        index[alarm['id']] = (alarm['insertionTime'], severity, str(alarm.get('alarmState') or ''),
+                              str(alarm.get('zoneId') or ''), str(alarm.get('apMac') or ''))
+
+    def update(self, alarms):
+        # Alarms inserted since the cursor, oldest first
+        # Read the whole response first, a failed read leaves the index as it was
+        alarms = list(alarms)
+        for alarm in alarms:
+            if not self.cursor.advance(alarm) or alarm.get('id') is None:
+                continue
+            severity = str(alarm.get('severity') or 'unknown')
+            self.raised[severity] += 1
+            if alarm.get('alarmState') == 'Cleared':
+                self._alarms.pop(alarm['id'], None)
+                continue
+            self._add(self._alarms, alarm, severity)
+            if len(self._alarms) > self.size:
+                self._alarms.popitem(last=False)
+                self._evicted.inc()
+
+    def resync(self, alarms):
+        # The alarms that are not cleared, newest first and at most `size` of them
+        alarms = list(alarms)
+        index = collections.OrderedDict()
+        for alarm in reversed(alarms):
+            if alarm.get('id') is None or type(alarm.get('insertionTime')) not in NUMBER_TYPES:
+                continue
+            if alarm.get('alarmState') != 'Cleared':
+                self._add(index, alarm, str(alarm.get('severity') or 'unknown'))
+        self._alarms = index
+        self._synced_at = time.monotonic()
+
+    def families(self):
+        zones = collections.Counter()
+        aps = collections.Counter()
+        for inserted, severity, state, zone_id, ap_mac in self._alarms.values():
+            zones[(zone_id, severity)] += 1
+            if ap_mac:
+                aps[(ap_mac, severity)] += 1
+        active = GaugeMetricFamily('smartzone_alarms_active', 'Number of alarms that are not cleared, by zone',
+                                   labels=['zone_id', 'severity'])
+        for (zone_id, severity), count in zones.items():
+            active.add_metric([intern_label(zone_id), intern_label(severity)], count)
+        ap_active = GaugeMetricFamily('smartzone_ap_alarms_active', 'Number of AP alarms that are not cleared',
+                                      labels=['ap_mac', 'severity'])
+        for (ap_mac, severity), count in aps.items():
+            ap_active.add_metric([intern_label(ap_mac), intern_label(severity)], count)
+        raised = CounterMetricFamily('smartzone_alarms_raised', 'Alarms raised since the exporter started',
+                                     labels=['severity'])
+        for severity, count in self.raised.items():
+            raised.add_metric([severity], count)
+        families = [active, ap_active, raised]
+        if self.cursor.position:
+            families.append(GaugeMetricFamily('smartzone_alarm_last_event_timestamp',
+                                              'Insertion time of the newest alarm read, in seconds since the epoch',
+                                              value=self.cursor.position / 1000))
+        return families
+
+    def state(self):
+        synced_age = None if self._synced_at is None else time.monotonic() - self._synced_at
+        return {'cursor': self.cursor.state(), 'raised': dict(self.raised), 'synced_age': synced_age,
+                'alarms': [[id] + list(alarm) for id, alarm in self._alarms.items()]}
+
+    def restore(self, state, downtime=0):
+        self.cursor = AlertCursor(*state['cursor'])
+        self.raised = collections.Counter(state['raised'])
+        if state['synced_age'] is not None:
+            self._synced_at = time.monotonic() - state['synced_age'] - downtime
+        self._alarms = collections.OrderedDict((alarm[0], tuple(alarm[1:])) for alarm in state['alarms'])
+
+
+class EventCounter():
+    # Events counted by severity and category, from the newest event at the first read on
+
+    def __init__(self):
+        self.cursor = AlertCursor()
+        self.counts = collections.Counter()
+
+    def start(self, latest):
+        # Position the cursor at the newest event, older events are not counted
+        if latest:
+            self.cursor.advance(latest[0])
+        else:
+            self.cursor.position = 0
+
+    def update(self, events):
+        for event in events:
+            if self.cursor.advance(event):
+                self.counts[(str(event.get('severity') or 'unknown'), str(event.get('category') or ''))] += 1
+
+    def families(self):
+        events = CounterMetricFamily('smartzone_events', 'Events since the exporter started',
+                                     labels=['severity', 'category'])
+        for (severity, category), count in self.counts.items():
+            events.add_metric([severity, intern_label(category)], count)
+        families = [events]
+        if self.cursor.position:
+            families.append(GaugeMetricFamily('smartzone_event_last_timestamp',
+                                              'Insertion time of the newest event read, in seconds since the epoch',
+                                              value=self.cursor.position / 1000))
+        return families
+
+    def state(self):
+        return {'cursor': self.cursor.state(), 'counts': [[severity, category, count] for (severity, category), count
+                                                          in self.counts.items()]}
+
+    def restore(self, state, downtime=0):
+        self.cursor = AlertCursor(*state['cursor'])
+        self.counts = collections.Counter({(severity, category): count
+                                           for severity, category, count in state['counts']})
+
+
+def parse_sections(value):
+    # Comma-separated section names, from the command line or the config file
+    sections = tuple(name.strip() for name in value.split(',') if name.strip())
+    for name in sections:
+        if name not in SECTIONS:
+            raise ValueError('Unknown section {}'.format(name))
+    return sections
+
+
+# Options with a fixed set of values, on the command line and in the config file
+AP_DETAIL_MODES = ('per-ap', 'bulk', 'incremental')
+ENGINES = ('threads', 'asyncio')
+JSON_PARSERS = ('auto', 'orjson', 'json', 'stream')
+
+
+def parse_choice(choices):
+    # Parser of a config value that must be one of `choices`
+    def parse(value):
+        if value not in choices:
+            raise ValueError('{} is not one of {}'.format(value, ', '.join(choices)))
+        return value
+    return parse
+
+
+# HTTP status codes worth retrying: the controller is overloaded or a service behind it is restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Seconds responses are reused for, per endpoint template
+# These change when the controller is reconfigured or upgraded, not between scrapes
+# The controller list is not cached, its uptime and cluster roles are live
+DEFAULT_CACHE_TTLS = {
+    'licenses': 3600,
+    'domains': 3600,
+    'system/devicesSummary': 900,
+}
+
+
+# Size-bounded cache of decoded API responses with a TTL per endpoint template
+# Endpoints without a TTL are never stored, so fast-changing statistics are always fetched
+class ResponseCache():
+
+    def __init__(self, ttls, max_entries, registry):
+        self._ttls = ttls
+        self._max_entries = max_entries
+        # Least recently used entries are evicted first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = Counter('smartzone_cache_hits', 'Total number of API responses served from the cache',
+                             ['endpoint'], registry=registry)
+        self._misses = Counter('smartzone_cache_misses', 'Total number of cacheable API responses not in the cache',
+                               ['endpoint'], registry=registry)
+        self._evictions = Counter('smartzone_cache_evictions', 'Total number of cache entries evicted for space',
+                                  registry=registry)
+        self._age = Gauge('smartzone_cache_age_seconds', 'Age of the cached response last served per endpoint',
+                          ['endpoint'], registry=registry)
+        entries = Gauge('smartzone_cache_entries', 'Number of API responses in the cache', registry=registry)
+        entries.set_function(lambda: len(self._entries))
+
+    def ttl(self, api_path):
+        return self._ttls.get(endpoint_name(api_path), 0)
+
+    def peek(self, api_path):
+        # Fresh cached value or None, without counting a hit or miss
+        with self._lock:
+            entry = self._entries.get(api_path)
+        if entry is not None and time.monotonic() < entry[0] + self.ttl(api_path):
+            return entry[1]
+        return None
+
+    def fresh(self, api_path):
+        return self.peek(api_path) is not None
+
+    def get(self, api_path):
+        ttl = self.ttl(api_path)
+        if ttl <= 0:
+            return None
+        endpoint = endpoint_name(api_path)
+        with self._lock:
+            entry = self._entries.get(api_path)
+            if entry is None or time.monotonic() >= entry[0] + ttl:
+                self._misses.labels(endpoint).inc()
+                return None
+            self._entries.move_to_end(api_path)
+        self._hits.labels(endpoint).inc()
+        self._age.labels(endpoint).set(time.monotonic() - entry[0])
+        return entry[1]
+
+    def put(self, api_path, value):
+        if self.ttl(api_path) <= 0:
+            return
+        with self._lock:
+            self._entries[api_path] = (time.monotonic(), value)
+            self._entries.move_to_end(api_path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._evictions.inc()
+
+
+# Label filters and a series limit applied to every family of a collection
+# Label values are interned, here and in MetricMap, so the strings repeated in every scrape
+# (MACs, names, zone ids) are shared by the snapshot, the remembered AP details and the next collection
+# Labels that are part of the sample structure rather than of the series, never removed by the label filters
+STRUCTURAL_LABELS = ('le', 'quantile')
+
+
+class SeriesBudget():
+
+    def __init__(self, drop_labels=None, allow_labels=None, max_series=0, registry=None):
+        # Label names matching drop_labels are removed, and when allow_labels is set only matching names are kept
+        self._drop = re.compile(drop_labels) if drop_labels else None
+        self._allow = re.compile(allow_labels) if allow_labels else None
+        # Samples kept per family, 0 is unlimited
+        self._max_series = max_series
+        self._dropped = Counter('smartzone_series_dropped', 'Total number of series dropped by the cardinality limits',
+                                ['family', 'reason'], registry=registry)
+
+    def _keep(self, label):
+        if self._drop is not None and self._drop.fullmatch(label):
+            return False
+        return self._allow is None or self._allow.fullmatch(label) is not None
+
+    def apply(self, family):
+        if (self._drop is None and self._allow is None and not self._max_series) or not family.samples:
+            return family
+        # Label names are matched once per family, le and quantile always stay as they shape histograms
+        decisions = {name: True for name in STRUCTURAL_LABELS}
+        seen = set()
+        series = set()
+        samples = []
+        duplicates = 0
+        over_limit = 0
+        for sample in family.samples:
+            labels = {}
+            removed = False
+            for name, value in sample.labels.items():
+                keep = decisions.get(name)
+                if keep is None:
+                    keep = decisions[name] = self._keep(name)
+                if keep:
+                    labels[name] = intern_label(value)
+                else:
+                    removed = True
+            # Series that only differed in a removed label collapse into the first one
+            if removed:
+                key = (sample.name, tuple(labels.items()))
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+            # The buckets, sum and count of a histogram count as one series, so it is kept or dropped whole
+            if self._max_series:
+                key = tuple(value for name, value in labels.items() if name not in STRUCTURAL_LABELS)
+                if key not in series:
+                    if len(series) >= self._max_series:
+                        over_limit += 1
+                        continue
+                    series.add(key)
+            samples.append(sample._replace(labels=labels))
+        if duplicates:
+            self._dropped.labels(family.name, 'duplicate').inc(duplicates)
+        if over_limit:
+            self._dropped.labels(family.name, 'limit').inc(over_limit)
+        family.samples = samples
+        return family
+
+
+# Counter families with reset detection, and per-second rates computed by the exporter with --rate-samples
+RATE_FAMILIES = frozenset(['smartzone_system_port_' + field for field in SYSTEM_PORT_COUNTERS] +
+                          ['smartzone_wlan_traffic', 'smartzone_wlan_traffic_uplink', 'smartzone_wlan_traffic_downlink'])
+
+
+class CounterHistory():
+    # The last samples of one counter series, as (time, value) pairs in a fixed-size ring of doubles
+    __slots__ = ('samples', 'next', 'count')
+
+    def __init__(self, size):
+        self.samples = array.array('d', bytes(16 * size))
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        size = len(self.samples) // 2
+        self.samples[2 * self.next] = timestamp
+        self.samples[2 * self.next + 1] = value
+        self.next = (self.next + 1) % size
+        self.count = min(self.count + 1, size)
+
+    def last(self):
+        return self.samples[2 * ((self.next - 1) % (len(self.samples) // 2)) + 1]
+
+    def rate(self):
+        # Per-second increase from the oldest to the newest sample
+        # A decrease is a counter reset, after which the counter is taken to have started from 0
+        size = len(self.samples) // 2
+        first = (self.next - self.count) % size
+        increase = 0
+        previous = None
+        for i in range(self.count):
+            value = self.samples[2 * ((first + i) % size) + 1]
+            if previous is not None:
+                increase += value - previous if value >= previous else value
+            previous = value
+        elapsed = self.samples[2 * ((self.next - 1) % size)] - self.samples[2 * first]
+        return increase / elapsed if elapsed > 0 else None
+
+
+class RateTracker():
+
+    def __init__(self, samples=0, registry=None):
+        # Rates span the last `samples` collections, below 2 only the last value is kept to detect resets
+        self._size = max(samples, 1)
+        self._rates = samples >= 2
+        # Family name -> {label pairs: CounterHistory}, series missing from a collection are forgotten
+        self._series = {}
+        self._lock = threading.Lock()
+        self._resets = Counter('smartzone_counter_resets', 'Times a counter decreased between collections',
+                               ['family'], registry=registry)
+
+    def observe(self, family, timestamp):
+        # Returns the <family>_per_second gauge family of a RATE_FAMILIES counter, or None
+        if family.name not in RATE_FAMILIES:
+            return None
+        rate = GaugeMetricFamily(family.name + '_per_second',
+                                 'Per-second increase of {}_total over the last {} collections'.format(
+                                     family.name, self._size))
+        resets = 0
+        with self._lock:
+            previous = self._series.get(family.name, {})
+            current = {}
+            for sample in family.samples:
+                if not sample.name.endswith('_total'):
+                    continue
+                key = tuple(sorted(sample.labels.items()))
+                history = previous.get(key)
+                if history is None:
+                    history = CounterHistory(self._size)
+                elif sample.value < history.last():
+                    resets += 1
+                history.append(timestamp, sample.value)
+                current[key] = history
+                if self._rates and history.count > 1:
+                    value = history.rate()
+                    if value is not None:
+                        rate.samples.append(Sample(rate.name, sample.labels, value, None))
+            self._series[family.name] = current
+        if resets:
+            self._resets.labels(family.name).inc(resets)
+        return rate if rate.samples else None
+
+
+def parse_bool(value):
+    # Boolean config values, like configparser's getboolean()
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError('Not a boolean: {}'.format(value))
+
+
+# The controller rejected the login, no further request of a scrape can succeed
+class LoginError(Exception):
+    pass
+
+
+def unreachable_error(e):
+    # Whether a failed request means the controller cannot be reached or refuses the login
+    if isinstance(e, (LoginError, requests.ConnectionError, requests.Timeout)):
+        return True
+    return aiohttp is not None and isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+# Transport adapter that counts new HTTPS connections, i.e. TLS handshakes with the controller
+class SmartZoneAdapter(HTTPAdapter):
+
+    def __init__(self, handshakes, **kwargs):
+        # HTTPAdapter.__init__ calls init_poolmanager, so the counter has to be set first
+        self._handshakes = handshakes
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        handshakes = self._handshakes
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                handshakes.inc()
+                return super()._new_conn()
+
+        # Replace the dict rather than updating it, older urllib3 shares it between pool managers
+        self.poolmanager.pool_classes_by_scheme = {'http': HTTPConnectionPool,
+                                                   'https': CountingHTTPSConnectionPool}
+
+
+# Single-flight coalescing of on-demand scrapes
+# Calls of run() with a key whose call is still in flight wait for it and share its result, or its exception.
+# A finished result is also reused for `window` seconds, and only kept that long.
+class SingleFlight():
+
+    def __init__(self, window=0, coalesced=None):
+        self._window = window
+        self._coalesced = coalesced
+        # key -> [done event, result, exception, finished at]
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and (not flight[0].is_set() or time.monotonic() - flight[3] < self._window):
+                leader = False
+                if self._coalesced is not None:
+                    self._coalesced.inc()
+            else:
+                flight = self._flights[key] = [threading.Event(), None, None, None]
+                leader = True
+
+        if leader:
+            try:
+                flight[1] = function()
+            except Exception as e:
+                flight[2] = e
+                raise
+            finally:
+                flight[3] = time.monotonic()
+                flight[0].set()
+                if self._window <= 0:
+                    with self._lock:
+                        if self._flights.get(key) is flight:
+                            del self._flights[key]
+        else:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+        return flight[1]
+
+
+# Token bucket limiting the request rate of the asyncio engine
+# Only used from the engine's event loop thread, so it needs no locking
+class TokenBucket():
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._capacity = max(burst, 1)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+# asyncio collection engine - issues all API calls of a scrape concurrently with aiohttp
+# The event loop and aiohttp session live in a dedicated thread, so connections and the login are reused
+class AsyncEngine():
+
+    def __init__(self, collector, max_concurrency=10, rate_limit=0, rate_burst=10, endpoint_rate_limits=None):
+        self._collector = collector
+        self._max_concurrency = max_concurrency
+        # Global bucket, plus optional buckets per endpoint template
+        self._bucket = TokenBucket(rate_limit, rate_burst) if rate_limit > 0 else None
+        self._endpoint_buckets = {endpoint: TokenBucket(rate, rate_burst)
+                                  for endpoint, rate in (endpoint_rate_limits or {}).items() if rate > 0}
+
+        # Created on the loop, asyncio primitives bind to the loop they are created on in Python 3.7
+        self._session = None
+        self._semaphore = None
+        self._login_lock = None
+        self._logged_in_at = None
+        self._login_generation = 0
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def run(self, coro):
+        # Run a coroutine on the engine loop and wait for its result from the calling thread
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _ensure_session(self):
+        if self._session is not None:
+            return
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._login_lock = asyncio.Lock()
+
+        # Count new connections like the requests adapter does
+        handshakes = self._collector._handshakes
+        trace = aiohttp.TraceConfig()
+
+        async def on_connection_create_end(session, context, params):
+            handshakes.inc()
+        trace.on_connection_create_end.append(on_connection_create_end)
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self._collector._timeout),
+            # SmartZone is usually addressed by IP, which the default cookie jar refuses to store cookies for
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            headers=self._collector._headers,
+            trace_configs=[trace] if self._collector._target.startswith('https') else [])
+
+    def _url(self, api_path):
+        return '{}/wsg/api/public/v12_0/{}'.format(self._collector._target, api_path)
+
+    def _ssl(self):
+        # `insecure` is the verify flag, False disables certificate checks
+        return None if self._collector._insecure else False
+
+    async def _login(self, generation, reason):
+        async with self._login_lock:
+            if self._login_generation != generation:
+                return
+            if self._logged_in_at is not None:
+                self._collector._reauths.labels(reason).inc()
+            self._session.cookie_jar.clear()
+            await self._send('get', 'session')
+            payload = {'username': self._collector._user, 'password': self._collector._password}
+            r, body = await self._send('post', 'session', json=payload)
+            try:
+                r.raise_for_status()
+            except aiohttp.ClientResponseError as e:
+                raise LoginError('Login to {} failed: {}'.format(self._collector._target, e)) from e
+            self._collector._logins.inc()
+            self._logged_in_at = time.monotonic()
+            self._login_generation += 1
+
+    def _session_expired(self):
+        ttl = self._collector._session_ttl
+        return ttl > 0 and time.monotonic() - self._logged_in_at >= ttl
+
+    async def _send(self, method, api_path, **kwargs):
+        start = time.monotonic()
+        try:
+            async with self._session.request(method, self._url(api_path), ssl=self._ssl(), **kwargs) as r:
+                body = await r.read()
+        except Exception as e:
+            self._collector.observe_error(api_path, e)
+            raise
+        self._collector.observe_response(method, api_path, r.status, time.monotonic() - start, len(body))
+        # The response is closed, but its status and request info are kept for raise_for_status()
+        return r, body
+
+    async def _attempt(self, method, api_path, **kwargs):
+        generation = self._login_generation
+        if self._logged_in_at is None or self._session_expired():
+            await self._login(generation, 'expired')
+            generation = self._login_generation
+
+        for bucket in (self._bucket, self._endpoint_buckets.get(endpoint_name(api_path))):
+            if bucket is not None:
+                await bucket.acquire()
+
+        async with self._semaphore:
+            r, body = await self._send(method, api_path, **kwargs)
+            if r.status == 401:
+                # Session invalidated on the controller side: log in again once
+                await self._login(generation, 'unauthorized')
+                r, body = await self._send(method, api_path, **kwargs)
+        return r, body
+
+    async def request(self, method, api_path, **kwargs):
+        # Same retry rules as SmartZoneCollector._request()
+        await self._ensure_session()
+        collector = self._collector
+        attempt = 0
+        while True:
+            try:
+                r, body = await self._attempt(method, api_path, **kwargs)
+                if r.status not in RETRY_STATUSES or attempt >= collector._retries:
+                    r.raise_for_status()
+                    return collector._decode(body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= collector._retries:
+                    raise
+            collector._retried.labels(endpoint_name(api_path)).inc()
+            await asyncio.sleep(collector._retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    async def fetch_page(self, api_path, page):
+        method, kwargs = self._collector._page_request(api_path, page)
+        result = await self.request(method, api_path, **kwargs)
+        self._collector._pages_fetched.labels(api_path).inc()
+        # No incremental parsing here, but prefetched pages are still reduced to the used fields
+        fields = LIST_FIELDS.get(endpoint_name(api_path))
+        if fields is not None:
+            result['list'] = project(result.get('list', []), fields)
+        return result
+
+    async def fetch_pages(self, api_path):
+        # Same paging rules as SmartZoneCollector.get_pages(), returns the list of every page
+        result = await self.fetch_page(api_path, 0)
+        pages = [result.get('list', [])]
+        if not result.get('hasMore'):
+            return pages
+
+        total = result.get('totalCount')
+        if total is None:
+            page = 1
+            while result.get('hasMore') and result.get('list'):
+                result = await self.fetch_page(api_path, page)
+                pages.append(result.get('list', []))
+                page += 1
+            return pages
+
+        count = -(-total // self._collector._page_size)
+        rest = await asyncio.gather(*[self.fetch_page(api_path, page) for page in range(1, count)])
+        return pages + [result.get('list', []) for result in rest]
+
+    async def _prefetch(self, list_paths, object_paths, statistics, ap_summaries):
+        results = {}
+
+        cache = self._collector._cache
+
+        # A failed endpoint is stored as its exception, raised again when the collector reads it,
+        # so it only fails its own section of the scrape
+        async def fetch_object(path):
+            if not cache.fresh(path):
+                try:
+                    results[path] = await self.request('get', path)
+                except Exception as e:
+                    results[path] = e
+
+        async def fetch_list(path):
+            # Cached lists are not fetched, but still drive the dependent calls
+            pages = cache.peek(path)
+            if pages is None:
+                try:
+                    pages = results[path] = await self.fetch_pages(path)
+                except Exception as e:
+                    results[path] = e
+                    return
+            # Chain dependent calls as soon as the list they need is in
+            if path == 'controller' and statistics:
+                await asyncio.gather(*[fetch_object('controller/{}/statistics'.format(c['id']))
+                                       for page in pages for c in page])
+            elif path == 'aps' and ap_summaries:
+                await asyncio.gather(*[fetch_object('aps/{}/operational/summary'.format(ap['mac']))
+                                       for page in pages for ap in page if self._collector.in_shard(ap['mac'])])
+
+        await asyncio.gather(*([fetch_list(path) for path in list_paths] +
+                               [fetch_object(path) for path in object_paths]))
+        return results
+
+    def prefetch(self, list_paths, object_paths, statistics=True, ap_summaries=False):
+        # Fetch every endpoint of a scrape concurrently
+        # List paths map to their pages, object paths (and chained statistics / AP summaries) to the response
+        return self.run(self._prefetch(list_paths, object_paths, statistics, ap_summaries))
+
+    async def _fetch_objects(self, paths):
+        # Failed requests are returned as their exception, like in _prefetch()
+        results = await asyncio.gather(*[self.request('get', path) for path in paths], return_exceptions=True)
+        return dict(zip(paths, results))
+
+    def fetch_objects(self, paths):
+        return self.run(self._fetch_objects(paths))
+
+    async def _close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def close(self):
+        self.run(self._close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
 # Create SmartZoneCollector as a class - in Python3, classes inherit object as a base class
 # Only need to specify for compatibility or in Python2
 
@@ -28,654 +1451,1638 @@ class SmartZoneCollector():
 
     # Initialize the class and specify required argument with no default value
     # When defining class methods, must explicitly list `self` as first argument
-    def __init__(self, target, user, password, insecure):
+    def __init__(self, target, user, password, insecure, session_ttl=0, page_size=1000, page_concurrency=4,
+                 ap_detail_mode='per-ap', engine='threads', max_concurrency=10, rate_limit=0, rate_burst=10,
+                 endpoint_rate_limits=None, executor=None, cache_ttls=None, cache_size=10000,
+                 ap_refresh_fraction=0.05, json_parser='auto', timeout=30, retries=2, retry_backoff=0.5,
+                 sections=SECTIONS, drop_labels=None, allow_labels=None, max_series=0, ap_info=False,
+                 rate_samples=0, coalesce_window=0, shard_index=0, shard_count=1, alarm_index_size=10000,
+                 alarm_resync=300):
         # Strip any trailing "/" characters from the provided url
         self._target = target.rstrip("/")
         # Take these arguments as provided, no changes needed
         self._user = user
         self._password = password
         self._insecure = insecure
-
-        self._headers = None
-        self._statuses = None
+        # Seconds after which the session is renewed proactively, 0 only renews on a 401
+        self._session_ttl = session_ttl
+        # Entities requested per page, and how many further pages may be in flight at once
+        self._page_size = page_size
+        self._page_concurrency = page_concurrency
+        # 'per-ap' calls operational/summary for every AP, 'bulk' reads query/ap and only falls back per AP,
+        # 'incremental' calls operational/summary only for APs that changed according to query/ap
+        self._ap_detail_mode = ap_detail_mode
+        # PER_AP_ONLY_FIELDS of every AP, keyed by MAC
+        self._ap_static = {}
+        # Incremental mode: (fingerprint, detail, refreshed at) of every AP keyed by MAC,
+        # and the share of unchanged APs refreshed anyway each cycle so no detail gets too old
+        self._ap_known = {}
+        self._ap_fingerprints = {}
+        self._ap_refresh_fraction = ap_refresh_fraction
+        # 'auto' uses orjson when installed, 'stream' parses LIST_FIELDS endpoints incrementally with ijson
+        self._json_parser = json_parser
+        # Replica shard_index of shard_count collects only the APs whose MAC hashes to it,
+        # and the controller-wide sections only when it is shard 0
+        if not 0 <= shard_index < shard_count:
+            raise ValueError('shard_index must be between 0 and shard_count - 1')
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        if shard_index > 0:
+            sections = [name for name in sections if name in SHARDED_SECTIONS]
+        # Sections collected when a scrape does not select any
+        self.sections = tuple(sections)
+        # Fold the string-only AP families into one smartzone_ap_info series per AP
+        self._ap_info = ap_info
+        # Seconds before a request is abandoned, and how often a failed request is tried again
+        # Retries wait retry_backoff, then twice as long after every further failure
+        self._timeout = timeout
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        # Worker threads for the per-AP calls, or the in-flight request limit of the asyncio engine
+        self._max_concurrency = max_concurrency
+        # Worker pool for page fetches and per-AP calls, passed in when several targets share one pool
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+        self._headers = {'Content-Type': 'application/json;charset=UTF-8'}
+
+        # One long-lived session per controller, logged in lazily and reused across scrapes
+        self._session = None
+        self._logged_in_at = None
+        # Incremented on every login so concurrent workers hitting a 401 only trigger one re-login
+        self._login_generation = 0
+        self._login_lock = threading.Lock()
+
+        # Exporter self-metrics, kept in a private registry and appended to every collection
+        self._registry = CollectorRegistry()
+        self._logins = Counter('smartzone_logins', 'Total number of SmartZone API logins',
+                               registry=self._registry)
+        self._reauths = Counter('smartzone_reauth', 'Total number of SmartZone API re-logins',
+                                ['reason'], registry=self._registry)
+        self._handshakes = Counter('smartzone_tls_handshakes', 'Total number of new TLS connections to SmartZone',
+                                   registry=self._registry)
+        self._pages_fetched = Counter('smartzone_api_pages_fetched', 'Total number of list pages fetched from SmartZone',
+                                      ['endpoint'], registry=self._registry)
+        self._request_duration = Histogram('smartzone_api_request_duration_seconds',
+                                           'Latency of SmartZone API requests', ['endpoint', 'method'],
+                                           registry=self._registry)
+        self._response_size = Histogram('smartzone_api_response_size_bytes', 'Size of SmartZone API responses',
+                                        ['endpoint'], buckets=[1024 * 4 ** i for i in range(10)],
+                                        registry=self._registry)
+        self._responses = Counter('smartzone_api_responses', 'Total number of SmartZone API responses by status code',
+                                  ['endpoint', 'code'], registry=self._registry)
+        self._request_errors = Counter('smartzone_api_request_errors',
+                                       'Total number of SmartZone API requests that failed without a response',
+                                       ['endpoint', 'error'], registry=self._registry)
+        self._retried = Counter('smartzone_api_retries', 'Total number of SmartZone API requests retried',
+                                ['endpoint'], registry=self._registry)
+        self._entities = Gauge('smartzone_api_entities', 'Number of entities returned by a list API in the last collection',
+                               ['endpoint'], registry=self._registry)
+        self._collection_duration = Histogram('smartzone_collection_duration_seconds',
+                                              'Duration of a complete collection from SmartZone',
+                                              buckets=(0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300, 600),
+                                              registry=self._registry)
+        self._ap_refreshes = Counter('smartzone_ap_detail_refreshes',
+                                     'Total number of AP details fetched in incremental mode, by reason',
+                                     ['reason'], registry=self._registry)
+        self._ap_reuses = Counter('smartzone_ap_detail_reuses',
+                                  'Total number of unchanged AP details reused in incremental mode',
+                                  registry=self._registry)
+        self._shard_aps = None
+        if shard_count > 1:
+            Gauge('smartzone_shard_info', 'Shard of this exporter replica', ['shard', 'shards'],
+                  registry=self._registry).labels(str(shard_index), str(shard_count)).set(1)
+            self._shard_aps = Gauge('smartzone_shard_aps', 'Number of APs assigned to this shard in the last '
+                                    'collection', registry=self._registry)
+
+        # Label filters and series limit applied to every family
+        self._budget = SeriesBudget(drop_labels, allow_labels, max_series, self._registry)
+        # Reset detection of the RATE_FAMILIES counters, and their per-second rates over rate_samples collections
+        self._rates = RateTracker(rate_samples, self._registry)
+
+        # Concurrent scrapes of the same sections share one collection, reused for coalesce_window seconds
+        self._flights = SingleFlight(coalesce_window, Counter(
+            'smartzone_coalesced_scrapes', 'Scrapes answered with the result of a collection already in flight '
+            'or finished within the coalescing window', registry=self._registry))
+
+        # Alarms and events read incrementally across collections, one collection at a time
+        # Extra query criteria of their list APIs, e.g. the time range, are kept per path for _page_request()
+        self._alarms = AlarmIndex(alarm_index_size, alarm_resync, Counter(
+            'smartzone_alarms_evicted', 'Alarms forgotten because the alarm index was full', registry=self._registry))
+        self._events = EventCounter()
+        self._alerts_lock = threading.Lock()
+        self._list_criteria = {}
+
+        # Responses of slow-changing endpoints are reused across scrapes
+        self._cache = ResponseCache(DEFAULT_CACHE_TTLS if cache_ttls is None else cache_ttls, cache_size,
+                                    self._registry)
+
+        # The asyncio engine fetches all endpoints of a scrape up front, the metric loops then read
+        # the responses from the `prefetched` dict of their scrape instead of calling the API themselves
+        self._engine = None
+        if engine == 'asyncio':
+            self._engine = AsyncEngine(self, max_concurrency, rate_limit, rate_burst, endpoint_rate_limits)
 
         # With the exception of uptime, all of these metrics are strings
         # Following the example of node_exporter, we'll set these string metrics with a default value of 1
 
+    def _new_session(self):
+        # Session object used to keep persistent cookies and connection pooling
+        # Pool size matches the AP worker threads so every worker keeps its own connection alive
+        s = requests.Session()
+        adapter = SmartZoneAdapter(self._handshakes, pool_connections=1, pool_maxsize=self._max_concurrency)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        s.headers.update(self._headers)
+        return s
+
     def get_session(self):
         # Disable insecure request warnings if SSL verification is disabled
         if self._insecure == False:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-        # Session object used to keep persistent cookies and connection pooling
-        s = requests.Session()
+        if self._session is None:
+            self._session = self._new_session()
+        else:
+            # Drop the stale JSESSIONID before logging in again
+            self._session.cookies.clear()
 
         # Set `verify` variable to enable or disable SSL checking
-        # Use string method format methods to create new string with inserted value (in this case, the URL)
-        s.get('{}/wsg/api/public/v12_0/session'.format(self._target), verify=self._insecure)
+        # Passed per request, a session-level verify=False is overridden by REQUESTS_CA_BUNDLE
+        self._send('get', 'session', verify=self._insecure, timeout=self._timeout)
 
         # Define URL arguments as a dictionary of strings 'payload'
         payload = {'username': self._user, 'password': self._password}
 
         # Call the payload using the json parameter
-        r = s.post('{}/wsg/api/public/v12_0/session'.format(self._target), json=payload, verify=self._insecure)
-
-        # Raise bad requests
-        r.raise_for_status()
-
-        # Create a dictionary from the cookie name-value pair, then get the value based on the JSESSIONID key
-        session_id = r.cookies.get_dict().get('JSESSIONID')
-
-        # Add HTTP headers for all requests EXCEPT logon API
-        # Integrate the session ID into the header
-        self._headers = {'Content-Type': 'application/json;charset=UTF-8', 'Cookie': 'JSESSIONID={}'.format(session_id)}
-
-    def get_metrics(self, metrics, api_path):
+        # The JSESSIONID cookie from the response is kept in the session cookie jar for all later requests
+        r = self._send('post', 'session', json=payload, verify=self._insecure, timeout=self._timeout)
+
+        # Raise bad requests, as a LoginError so the scrape stops instead of trying every section
+        try:
+            r.raise_for_status()
+        except requests.HTTPError as e:
+            raise LoginError('Login to {} failed: {}'.format(self._target, e)) from e
+
+        self._logins.inc()
+        self._logged_in_at = time.monotonic()
+        self._login_generation += 1
+
+    def _session_expired(self):
+        return self._session_ttl > 0 and time.monotonic() - self._logged_in_at >= self._session_ttl
+
+    def _login(self, generation, reason):
+        # Log in unless another thread already did so since `generation` was read
+        with self._login_lock:
+            if self._login_generation != generation:
+                return
+            if self._logged_in_at is not None:
+                self._reauths.labels(reason).inc()
+            self.get_session()
+
+    def observe_response(self, method, api_path, status, seconds, size):
+        # Record one API response, `size` is None when the body length is not known up front
+        endpoint = endpoint_name(api_path)
+        self._request_duration.labels(endpoint, method.upper()).observe(seconds)
+        self._responses.labels(endpoint, str(status)).inc()
+        if size is not None:
+            self._response_size.labels(endpoint).observe(size)
+
+    def observe_error(self, api_path, error):
+        self._request_errors.labels(endpoint_name(api_path), type(error).__name__).inc()
+
+    def _send(self, method, api_path, **kwargs):
+        # Use string method format methods to create new string with inserted value (in this case, the URL)
+        url = '{}/wsg/api/public/v12_0/{}'.format(self._target, api_path)
+        start = time.monotonic()
+        try:
+            r = self._session.request(method, url, **kwargs)
+        except Exception as e:
+            self.observe_error(api_path, e)
+            raise
+        if kwargs.get('stream'):
+            # Streamed bodies are read later, only the announced length is known here
+            length = r.headers.get('Content-Length')
+            size = int(length) if length is not None else None
+        else:
+            size = len(r.content)
+        self.observe_response(method, api_path, r.status_code, time.monotonic() - start, size)
+        return r
+
+    def _attempt(self, method, api_path, **kwargs):
+        generation = self._login_generation
+        if self._logged_in_at is None or self._session_expired():
+            self._login(generation, 'expired')
+            generation = self._login_generation
+
+        r = self._send(method, api_path, **kwargs)
+        # Session invalidated on the controller side (timeout, restart, admin logout): log in again once
+        if r.status_code == 401:
+            self._login(generation, 'unauthorized')
+            r = self._send(method, api_path, **kwargs)
+        return r
+
+    def _request(self, method, api_path, **kwargs):
+        # Connection errors, timeouts and RETRY_STATUSES are retried with exponential backoff,
+        # any other error status is raised
+        kwargs.setdefault('verify', self._insecure)
+        kwargs.setdefault('timeout', self._timeout)
+        attempt = 0
+        while True:
+            try:
+                r = self._attempt(method, api_path, **kwargs)
+                if r.status_code not in RETRY_STATUSES or attempt >= self._retries:
+                    r.raise_for_status()
+                    return r
+                r.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self._retries:
+                    raise
+            self._retried.labels(endpoint_name(api_path)).inc()
+            time.sleep(self._retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    def get_metrics(self, api_path, prefetched=None):
         # Add the individual URL paths for the API call
-        self._statuses = list(metrics.keys())
-        if 'query' in api_path:
-            # For APs, use POST and API query to reduce number of requests and improve performance
-            # To-do: set dynamic AP limit based on SmartZone inventory
-            raw = {'limit': 1000}
-            r = requests.post('{}/wsg/api/public/v12_0/{}'.format(self._target, api_path), json=raw,
-                              headers=self._headers, verify=self._insecure)
+        # Used for single-object responses, lists go through get_list() so they are paginated
+        # `prefetched` holds the responses the asyncio engine fetched for the current scrape
+        cached = self._cache.get(api_path)
+        if cached is not None:
+            return cached
+        if prefetched and api_path in prefetched:
+            result = prefetched.pop(api_path)
+            if isinstance(result, Exception):
+                raise result
         else:
-            r = requests.get('{}/wsg/api/public/v12_0/{}'.format(self._target, api_path + '?listSize=1000'),
-                             headers=self._headers,
-                             verify=self._insecure)
-        result = json.loads(r.text)
+            r = self._request('get', api_path)
+            result = self._decode(r.content)
+        self._cache.put(api_path, result)
         return result
 
-    def collect(self):
-
-        # Define metrics for client vlan membership (for WLANs with dynamic vlan assignment)
-
-        vlan_totals_metric = GaugeMetricFamily(
-            'smartzone_clients_per_vlan',
-            'Total number of clients on each VLAN',
-            labels=["zone_id", "vlan_id"]
-            )
-        vlan_ssid_metric = GaugeMetricFamily(
-            'smartzone_clients_per_vlan_ssid',
-            'Total number of clients on each VLAN per SSID',
-            labels=["zone_id", "vlan_id", "ssid"]
-        )
-
-        controller_metrics = {
-            'model':
-                GaugeMetricFamily('smartzone_controller_model',
-                                  'SmartZone controller model',
-                                  labels=["id", "model"]),
-            'description':
-                GaugeMetricFamily('smartzone_controller_description',
-                                  'SmartZone controller description',
-                                  labels=["id", "description"]),
-            'serialNumber':
-                GaugeMetricFamily('smartzone_controller_serial_number',
-                                  'SmartZone controller serial number',
-                                  labels=["id", "serialNumber"]),
-            'clusterRole':
-                GaugeMetricFamily('smartzone_controller_cluster_role',
-                                  'SmartZone controller cluster role',
-                                  labels=["id", "serialNumber"]),
-            'uptimeInSec':
-                CounterMetricFamily('smartzone_controller_uptime_seconds',
-                                    'Controller uptime in sections',
-                                    labels=["id"]),
-            'version':
-                GaugeMetricFamily('smartzone_controller_version',
-                                  'Controller version',
-                                  labels=["id", "version"]),
-            'apVersion':
-                GaugeMetricFamily('smartzone_controller_ap_firmware_version',
-                                  'Firmware version on controller APs',
-                                  labels=["id", "apVersion"])
-        }
-
-        zone_metrics = {
-            'totalAPs':
-                GaugeMetricFamily('smartzone_zone_total_aps',
-                                  'Total number of APs in zone',
-                                  labels=["zone_name", "zone_id"]),
-            'discoveryAPs':
-                GaugeMetricFamily('smartzone_zone_discovery_aps',
-                                  'Number of zone APs in discovery state',
-                                  labels=["zone_name", "zone_id"]),
-            'connectedAPs':
-                GaugeMetricFamily('smartzone_zone_connected_aps',
-                                  'Number of connected zone APs',
-                                  labels=["zone_name", "zone_id"]),
-            'disconnectedAPs':
-                GaugeMetricFamily('smartzone_zone_disconnected_aps',
-                                  'Number of disconnected zone APs',
-                                  labels=["zone_name", "zone_id"]),
-            'clients':
-                GaugeMetricFamily('smartzone_zone_total_connected_clients',
-                                  'Total number of connected clients in zone',
-                                  labels=["zone_name", "zone_id"])
-        }
-
-        system_metric = {
-            'cpu': {
-                'percent':
-                    GaugeMetricFamily('smartzone_system_cpu_usage',
-                                      'SmartZone system CPU usage',
-                                      labels=["id"])
-            },
-            'disk': {
-                'total':
-                    GaugeMetricFamily('smartzone_system_disk_size',
-                                      'SmartZone system disk size',
-                                      labels=["id"]),
-                'free':
-                    GaugeMetricFamily('smartzone_system_disk_free',
-                                      'SmartZone system disk free space',
-                                      labels=["id"]),
-            },
-            'memory': {
-                'percent':
-                    GaugeMetricFamily('smartzone_system_memory_usage',
-                                      'SmartZone system memory usage',
-                                      labels=["id"])
-            },
-            'control': {
-                'rxBps':
-                    GaugeMetricFamily('smartzone_system_port_rxBps',
-                                      'SmartZone system port  rxBps (Throughput)',
-                                      labels=["id", "port"]),
-                'rxBytes':
-                    GaugeMetricFamily('smartzone_system_port_rxBytes',
-                                      'SmartZone system port  total rxBytes',
-                                      labels=["id", "port"]),
-                'rxDropped':
-                    GaugeMetricFamily('smartzone_system_port_rxDropped',
-                                      'SmartZone system port  total rxDropped',
-                                      labels=["id", "port"]),
-                'rxPackets':
-                    GaugeMetricFamily('smartzone_system_port_rxPackets',
-                                      'SmartZone system port  total rxPackets',
-                                      labels=["id", "port"]),
-                'txBps':
-                    GaugeMetricFamily('smartzone_system_port_txBps',
-                                      'SmartZone system port  txBps (Throughput)',
-                                      labels=["id", "port"]),
-                'txBytes':
-                    GaugeMetricFamily('smartzone_system_port_txBytes',
-                                      'SmartZone system port  total txBytes',
-                                      labels=["id", "port"]),
-                'txDropped':
-                    GaugeMetricFamily('smartzone_system_port_txDropped',
-                                      'SmartZone system port  total txDropped',
-                                      labels=["id", "port"]),
-                'txPackets':
-                    GaugeMetricFamily('smartzone_system_port_txPackets',
-                                      'SmartZone system port  total txPackets',
-                                      labels=["id", "port"])
-            },
-            'port1': {
-                'rxBps':
-                    GaugeMetricFamily('smartzone_system_port_rxBps',
-                                      'SmartZone system port rxBps (Throughput)',
-                                      labels=["id", "port"]),
-                'rxBytes':
-                    GaugeMetricFamily('smartzone_system_port_rxBytes',
-                                      'SmartZone system port total rxBytes',
-                                      labels=["id", "port"]),
-                'rxDropped':
-                    GaugeMetricFamily('smartzone_system_port_rxDropped',
-                                      'SmartZone system port total rxDropped',
-                                      labels=["id", "port"]),
-                'rxPackets':
-                    GaugeMetricFamily('smartzone_system_port_rxPackets',
-                                      'SmartZone system port total rxPackets',
-                                      labels=["id", "port"]),
-                'txBps':
-                    GaugeMetricFamily('smartzone_system_port_txBps',
-                                      'SmartZone system port txBps (Throughput)',
-                                      labels=["id", "port"]),
-                'txBytes':
-                    GaugeMetricFamily('smartzone_system_port_txBytes',
-                                      'SmartZone system port total txBytes',
-                                      labels=["id", "port"]),
-                'txDropped':
-                    GaugeMetricFamily('smartzone_system_port_txDropped',
-                                      'SmartZone system port total txDropped',
-                                      labels=["id", "port"]),
-                'txPackets':
-                    GaugeMetricFamily('smartzone_system_port_txPackets',
-                                      'SmartZone system port total txPackets',
-                                      labels=["id", "port"])
-            },
-            'port2': {
-                'rxBps':
-                    GaugeMetricFamily('smartzone_system_port_rxBps',
-                                      'SmartZone system port rxBps (Throughput)',
-                                      labels=["id", "port"]),
-                'rxBytes':
-                    GaugeMetricFamily('smartzone_system_port_rxBytes',
-                                      'SmartZone system port total rxBytes',
-                                      labels=["id", "port"]),
-                'rxDropped':
-                    GaugeMetricFamily('smartzone_system_port_rxDropped',
-                                      'SmartZone system port total rxDropped',
-                                      labels=["id", "port"]),
-                'rxPackets':
-                    GaugeMetricFamily('smartzone_system_port_rxPackets',
-                                      'SmartZone system port total rxPackets',
-                                      labels=["id", "port"]),
-                'txBps':
-                    GaugeMetricFamily('smartzone_system_port_txBps',
-                                      'SmartZone system port txBps (Throughput)',
-                                      labels=["id", "port"]),
-                'txBytes':
-                    GaugeMetricFamily('smartzone_system_port_txBytes',
-                                      'SmartZone system port total txBytes',
-                                      labels=["id", "port"]),
-                'txDropped':
-                    GaugeMetricFamily('smartzone_system_port_txDropped',
-                                      'SmartZone system port total txDropped',
-                                      labels=["id", "port"]),
-                'txPackets':
-                    GaugeMetricFamily('smartzone_system_port_txPackets',
-                                      'SmartZone system port total txPackets',
-                                      labels=["id", "port"])
-            }
-        }
-
-        system_summary_metric = {
-            'maxApOfCluster':
-                GaugeMetricFamily('smartzone_cluster_maxAPs',
-                                  'SmartZone Cluster number of maximum possible connected APs',
-                                  labels=["id"]),
-            'totalRemainingApCapacity':
-                GaugeMetricFamily('smartzone_cluster_totalRemainingApCapacity',
-                                  'SmartZone Cluster number of total remaining possible connected APs',
-                                  labels=["id"]),
-        }
-
-        ap_list = {
-            'apGroupId':
-                GaugeMetricFamily('smartzone_aps_list_ap_groupId',
-                                  'SmartZone APs list ap groupId',
-                                  labels=["zone_id", "ap_name", "ap_mac", "groupId"]),
-            'serial':
-                GaugeMetricFamily('smartzone_aps_list_ap_serial',
-                                  'SmartZone APs list ap serial number',
-                                  labels=["zone_id", "ap_name", "ap_mac", "serial"])
-        }
-
-        ap_metrics = {
-            'mac':
-                GaugeMetricFamily('smartzone_ap_mac',
-                                  'SmartZone AP mac',
-                                  labels=["ap_mac", "mac"]),
-            'model':
-                GaugeMetricFamily('smartzone_ap_model',
-                                  'SmartZone AP model',
-                                  labels=["ap_mac", "model"]),
-            'version':
-                GaugeMetricFamily('smartzone_ap_version',
-                                  'SmartZone AP version',
-                                  labels=["ap_mac", "version"]),
-            'description':
-                GaugeMetricFamily('smartzone_ap_description',
-                                  'SmartZone AP description',
-                                  labels=["ap_mac", "description"]),
-            'zoneId':
-                GaugeMetricFamily('smartzone_ap_zoneId',
-                                  'SmartZone AP zone id',
-                                  labels=["ap_mac", "zoneId"]),
-            'connectionState':
-                GaugeMetricFamily('smartzone_ap_connectionState',
-                                  'SmartZone AP connection state',
-                                  labels=["ap_mac", "connectionState"]),
-             'wifi6gChannel':
-                 GaugeMetricFamily('smartzone_ap_wifi6gChannel',
-                                   'SmartZone AP 6GHz channel number',
-                                   labels=["ap_mac"]),
-            'wifi50Channel':
-                GaugeMetricFamily('smartzone_ap_wifi50Channel',
-                                  'SmartZone AP 5GHz channel number',
-                                  labels=["ap_mac"]),
-            'wifi24Channel':
-                GaugeMetricFamily('smartzone_ap_wifi24Channel',
-                                  'SmartZone AP 2.4GHz channel number',
-                                  labels=["ap_mac"]),
-            'approvedTime':
-                GaugeMetricFamily('smartzone_ap_approvedTime',
-                                  'SmartZone AP approved time',
-                                  labels=["ap_mac"]),
-            'lastSeenTime':
-                GaugeMetricFamily('smartzone_ap_lastSeenTime',
-                                  'SmartZone AP last seen time',
-                                  labels=["ap_mac"]),
-            'uptime':
-                GaugeMetricFamily('smartzone_ap_uptime',
-                                  'SmartZone AP uptime',
-                                  labels=["mac"]),
-            'clientCount':
-                GaugeMetricFamily('smartzone_ap_clientCount',
-                                  'SmartZone AP client count',
-                                  labels=["ap_mac"])
-        }
-
-        ap_summary_list = {
-            'location':
-                GaugeMetricFamily('smartzone_aps_location',
-                                  'SmartZone AP location',
-                                  labels=["ap_name", "ap_mac", "location"]),
-            'configState':
-                GaugeMetricFamily('smartzone_aps_configState',
-                                  'SmartZone AP configState',
-                                  labels=["ap_name", "ap_mac", "configState"]),
-            'criticalCount':
-                GaugeMetricFamily('smartzone_aps_alarms_criticalCount',
-                                  'SmartZone AP criticalCount alarm',
-                                  labels=["ap_name", "ap_mac"]),
-            'majorCount':
-                GaugeMetricFamily('smartzone_aps_alarms_majorCount',
-                                  'SmartZone majorCount alarms',
-                                  labels=["ap_name", "ap_mac"]),
-            'minorCount':
-                GaugeMetricFamily('smartzone_aps_alarms_minorCount',
-                                  'SmartZone AP minorCount alarms',
-                                  labels=["ap_name", "ap_mac"]),
-            'warningCount':
-                GaugeMetricFamily('smartzone_aps_alarms_warningCount',
-                                  'SmartZone AP warningCount alarm',
-                                  labels=["ap_name", "ap_mac"])
-        }
-
-        domain_metrics = {
-            'domainType':
-                GaugeMetricFamily('smartzone_domain_type',
-                                  'SmartZone Domain name',
-                                  labels=["domain_id", "domain_name", "domainType"]),
-            'parentDomainId':
-                GaugeMetricFamily('smartzone_domain_parentDomainId',
-                                  'SmartZone Domain parent domain ID',
-                                  labels=["domain_id", "domain_name", "parentDomainId"]),
-            'subDomainCount':
-                GaugeMetricFamily('smartzone_domain_subDomainCount',
-                                  'SmartZone Domain sub domain numbers',
-                                  labels=["domain_id", "domain_name"]),
-            'apCount':
-                GaugeMetricFamily('smartzone_domain_apCount',
-                                  'SmartZone Domain total count of APs',
-                                  labels=["domain_id", "domain_name"]),
-            'zoneCount':
-                GaugeMetricFamily('smartzone_domain_zoneCount',
-                                  'SmartZone Domain count of zones',
-                                  labels=["domain_id", "domain_name"])
-        }
-
-        license_metrics = {
-            'description':
-                GaugeMetricFamily('smartzone_license_description',
-                                  'SmartZone License description',
-                                  labels=["license_name", "description"]),
-            'count':
-                GaugeMetricFamily('smartzone_license_count',
-                                  'SmartZone License count',
-                                  labels=["license_name"]),
-            'createTime':
-                GaugeMetricFamily('smartzone_license_createTime',
-                                  'SmartZone License created date',
-                                  labels=["license_name", "createTime"]),
-            'expireDate':
-                GaugeMetricFamily('smartzone_license_expireDate',
-                                  'SmartZone License expire date',
-                                  labels=["license_name", "expireDate"])
-        }
-
-        wlan_list = {
-            'ssid':
-                GaugeMetricFamily('smartzone_wlan_ssid',
-                                  'SmartZone SSID',
-                                  labels=["zoneId", "name", "ssid"]),
-            'clients':
-                GaugeMetricFamily('smartzone_wlan_clients',
-                                  'SmartZone WLAN clients',
-                                  labels=["zoneId", "name"]),
-            'traffic':
-                GaugeMetricFamily('smartzone_wlan_traffic',
-                                  'SmartZone WLAN traffic',
-                                  labels=["zoneId", "name"]),
-            'trafficUplink':
-                GaugeMetricFamily('smartzone_wlan_traffic_uplink',
-                                  'SmartZone WLAN traffic Uplink',
-                                  labels=["zoneId", "name"]),
-            'trafficDownlink':
-                GaugeMetricFamily('smartzone_wlan_traffic_downlink',
-                                  'SmartZone WLAN traffic Downlink',
-                                  labels=["zoneId", "name"]),
-            'vlan':
-                GaugeMetricFamily('smartzone_wlan_vlan',
-                                  'SmartZone WLAN vlan',
-                                  labels=["zoneId", "name"]),
-}
-
-        self.get_session()
-
-        id = 0
-        # Get SmartZone controller metrics
-        for c in self.get_metrics(controller_metrics, 'controller')['list']:
-            id = c['id']
-            for s in self._statuses:
-                if s == 'uptimeInSec':
-                    controller_metrics[s].add_metric([id], c.get(s))
-                # Export a dummy value for string-only metrics
-                else:
-                    extra = c[s]
-                    controller_metrics[s].add_metric([id, extra], 1)
+    def try_get_metrics(self, api_path, prefetched=None, errors=None):
+        # get_metrics() for the per-AP fan-out, a failing AP returns None instead of failing the others
+        # The failures are collected in `errors` as (api_path, exception), the section logs them once
+        try:
+            return self.get_metrics(api_path, prefetched)
+        except Exception as e:
+            if errors is not None:
+                errors.append((api_path, e))
+            return None
+
+    def _page_request(self, api_path, page):
+        # Method and request arguments for a page of a list API, pages are counted from 0 here
+        if 'query' in api_path or api_path.startswith('alert/'):
+            # For APs, use POST and API query to reduce number of requests and improve performance
+            # Query API pages are numbered from 1, further criteria come from query_list()
+            return 'post', {'json': dict({'page': page + 1, 'limit': self._page_size},
+                                         **self._list_criteria.get(api_path, {}))}
+        # Plain list APIs are addressed by the index of the first entity
+        return 'get', {'params': {'index': page * self._page_size, 'listSize': self._page_size}}
+
+    def _decode(self, data):
+        # Parse from bytes, r.text would first decode (and possibly charset-detect) the whole body
+        if orjson is not None and self._json_parser in ('auto', 'orjson', 'stream'):
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def _fetch_page(self, api_path, page):
+        method, kwargs = self._page_request(api_path, page)
+        fields = LIST_FIELDS.get(endpoint_name(api_path))
+        if fields is not None and self._json_parser == 'stream':
+            # Parse while reading from the socket, only the used fields of each entry are kept
+            r = self._request(method, api_path, stream=True, **kwargs)
+            r.raw.decode_content = True
+            result = stream_page(r.raw, fields)
+            # Read what is left after the closing brace so the connection goes back to the pool
+            r.raw.read()
+            r.raw.release_conn()
+        else:
+            r = self._request(method, api_path, **kwargs)
+            result = self._decode(r.content)
+            if fields is not None:
+                result['list'] = project(result.get('list', []), fields)
+        self._pages_fetched.labels(api_path).inc()
+        return result
 
-        for m in controller_metrics.values():
+    def get_pages(self, api_path, prefetched=None):
+        # Yield the 'list' of every page in order, so callers can build metrics while later pages are fetched
+        entities = 0
+        for page in self._get_pages(api_path, prefetched):
+            entities += len(page)
+            yield page
+        self._entities.labels(endpoint_name(api_path)).set(entities)
+
+    def _get_pages(self, api_path, prefetched):
+        cached = self._cache.get(api_path)
+        if cached is not None:
+            for page in cached:
+                yield page
+            return
+
+        if prefetched and api_path in prefetched:
+            pages = prefetched.pop(api_path)
+            if isinstance(pages, Exception):
+                raise pages
+        elif self._cache.ttl(api_path) > 0:
+            pages = self._fetch_pages(api_path)
+        else:
+            # Not cacheable, stream the pages without keeping them
+            for page in self._fetch_pages(api_path):
+                yield page
+            return
+
+        # Keep the pages of cacheable lists, stored only once the list has been read completely
+        kept = []
+        for page in pages:
+            kept.append(page)
+            yield page
+        self._cache.put(api_path, kept)
+
+    def _fetch_pages(self, api_path):
+        result = self._fetch_page(api_path, 0)
+        yield result.get('list', [])
+        if not result.get('hasMore'):
+            return
+
+        total = result.get('totalCount')
+        if total is None:
+            # Size unknown, follow hasMore one page at a time
+            page = 1
+            while True:
+                result = self._fetch_page(api_path, page)
+                yield result.get('list', [])
+                if not result.get('hasMore') or not result.get('list'):
+                    return
+                page += 1
+
+        # Size known, fetch the remaining pages concurrently
+        # Only a window of page_concurrency pages is in flight, which bounds memory for huge lists
+        pages = -(-total // self._page_size)
+        next_page = 1
+        pending = collections.deque()
+        while next_page < pages or pending:
+            while next_page < pages and len(pending) < self._page_concurrency:
+                pending.append(self._executor.submit(self._fetch_page, api_path, next_page))
+                next_page += 1
+            yield pending.popleft().result().get('list', [])
+
+    def get_list(self, api_path, prefetched=None):
+        # Paginated counterpart of get_metrics(), returns an iterator over all entities of a list API
+        return itertools.chain.from_iterable(self.get_pages(api_path, prefetched))
+
+    def query_list(self, api_path, criteria):
+        # Entities of a query API matching `criteria`, e.g. a time range and sort order
+        # Never prefetched or cached, the criteria of the alert lists change with every read
+        self._list_criteria[api_path] = criteria
+        if self._engine is not None:
+            return itertools.chain.from_iterable(self._engine.run(self._engine.fetch_pages(api_path)))
+        return itertools.chain.from_iterable(self._fetch_pages(api_path))
+
+    def query_page(self, api_path, criteria):
+        # Only the first page of query_list()
+        self._list_criteria[api_path] = criteria
+        if self._engine is not None:
+            return self._engine.run(self._engine.fetch_page(api_path, 0)).get('list', [])
+        return self._fetch_page(api_path, 0).get('list', [])
+
+    def close(self):
+        # Release connections and worker threads of a collector that is no longer used
+        if self._engine is not None:
+            self._engine.close()
+        if self._session is not None:
+            self._session.close()
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def state(self):
+        # What a restarted exporter needs to continue where this one stopped, as JSON-compatible values:
+        # the remembered AP details, the alarm and event cursors, and the API session unless the asyncio engine
+        # keeps its own
+        # Times are stored as ages, monotonic clocks do not survive a restart
+        now = time.monotonic()
+        state = {'ap_static': self._ap_static,
+                 'ap_known': {mac: [fingerprint, detail, now - refreshed_at]
+                              for mac, (fingerprint, detail, refreshed_at) in list(self._ap_known.items())}}
+        with self._alerts_lock:
+            state['alarms'] = self._alarms.state()
+            state['events'] = self._events.state()
+        if self._engine is None and self._session is not None and self._logged_in_at is not None:
+            state['session'] = {'cookies': requests.utils.dict_from_cookiejar(self._session.cookies),
+                                'age': now - self._logged_in_at}
+        return state
+
+    def restore_state(self, state, downtime=0):
+        # Inverse of state(), `downtime` seconds passed since it was saved
+        now = time.monotonic()
+        self._ap_static = state.get('ap_static', {})
+        self._ap_known = {mac: (tuple(fingerprint) if fingerprint is not None else None, detail,
+                                now - age - downtime)
+                          for mac, (fingerprint, detail, age) in state.get('ap_known', {}).items()}
+        # Reading continues from the saved cursors, so alarms and events of the downtime are not missed
+        with self._alerts_lock:
+            if 'alarms' in state:
+                self._alarms.restore(state['alarms'], downtime)
+            if 'events' in state:
+                self._events.restore(state['events'], downtime)
+        session = state.get('session')
+        if session is not None and self._engine is None:
+            # A session the controller expired in the meantime is answered with 401 and replaced by a new login
+            self._session = self._new_session()
+            self._session.cookies.update(session['cookies'])
+            self._logged_in_at = now - session['age'] - downtime
+
+    def collect(self, sections=None):
+        # Scrapes in on-demand mode: HA Prometheus servers scraping at once trigger a single collection
+        key = None if sections is None else tuple(sorted(set(sections)))
+        for m in self._flights.run(key, lambda: list(self.scrape(sections))):
             yield m
-
-        # Get SmartZone system metric
-
-        path = 'controller/' + id + '/statistics'
-        system = self.get_metrics(system_metric, path)
-        for c in system_metric:
-            varList = list(system_metric[c].keys())
-            for s in varList:
-                # Add dummy comment (port name) for port statistic
-                if c == 'port1' or c == 'port2' or c == 'control' or c == 'cluster' or c == 'management':
-                    system_metric[c][s].add_metric([id, c], system[0][c].get(s))
-                # For normal metric
-                else:
-                    system_metric[c][s].add_metric([id], system[0][c].get(s))
-            for m in system_metric[c].values():
-                yield m
-
-        # Ges SmartZone system summary
-        c = self.get_metrics(system_summary_metric, 'system/devicesSummary')
-        for s in self._statuses:
-            system_summary_metric[s].add_metric([id], c.get(s))
-
-        for m in system_summary_metric.values():
+        for m in self.internal_metrics():
             yield m
 
-        # Get SmartZone inventory per zone
-        # For each zone captured from the query:
-        # - Grab the zone name and zone ID for labeling purposes
-        # - Loop through the statuses in statuses
-        # - For each status, get the value for the status in each zone and add to the metric
-
-        for zone in self.get_metrics(zone_metrics, 'system/inventory')['list']:
-            zone_name = zone['zoneName']
-            zone_id = zone['zoneId']
-            for s in self._statuses:
-                zone_metrics[s].add_metric([zone_name, zone_id], zone.get(s))
-
-        for m in zone_metrics.values():
+    def map_window(self, function, items):
+        # executor.map() that only keeps a window of calls submitted, so finished responses cannot pile up
+        # faster than the caller consumes them
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= 2 * self._max_concurrency:
+                yield pending.popleft().result()
+            pending.append(self._executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+    def in_shard(self, mac):
+        # Whether the AP is collected by this replica
+        return self._shard_count <= 1 or shard_of(mac, self._shard_count) == self._shard_index
+
+    def get_bulk_ap_details(self, prefetched=None):
+        # Build AP details from query/ap
+        # Returns the details that are complete, and the MACs that still need a per-AP summary call
+        details = []
+        fallback = []
+        seen = set()
+        for ap in self.get_list('query/ap', prefetched):
+            mac = ap.get('apMac')
+            if mac is None or not self.in_shard(mac):
+                continue
+            seen.add(mac)
+            static = self._ap_static.get(mac)
+            # Fall back for APs missing a field (older controller releases) or not fetched per AP yet
+            if static is None or any(f not in ap for f in BULK_AP_FIELDS.values()):
+                fallback.append(mac)
+                continue
+            detail = {d: ap.get(f) for d, f in BULK_AP_FIELDS.items()}
+            detail['connectionState'] = BULK_AP_STATUS.get(detail['connectionState'], detail['connectionState'])
+            detail.update(static)
+            details.append(detail)
+        # Forget APs that were removed from the controller
+        self._ap_static = {mac: static for mac, static in self._ap_static.items() if mac in seen}
+        return details, fallback
+
+    def get_incremental_ap_details(self, macs, prefetched=None):
+        # Decide from query/ap which AP details have to be fetched again
+        # Returns the remembered details of unchanged APs, and the MACs to fetch
+        rows = {}
+        for ap in self.get_list('query/ap', prefetched):
+            if ap.get('apMac') is not None and self.in_shard(ap['apMac']):
+                rows[ap['apMac']] = ap
+        self._ap_fingerprints = {mac: tuple(ap.get(f) for f in AP_CHANGE_FIELDS) for mac, ap in rows.items()}
+
+        fetch = []
+        unchanged = []
+        for mac in macs:
+            known = self._ap_known.get(mac)
+            if known is None:
+                fetch.append(mac)
+                self._ap_refreshes.labels('new').inc()
+            elif mac not in self._ap_fingerprints or known[0] != self._ap_fingerprints[mac]:
+                fetch.append(mac)
+                self._ap_refreshes.labels('changed').inc()
+            else:
+                unchanged.append(mac)
+
+        # Rolling refresh of the unchanged APs that were fetched longest ago
+        rolling = set()
+        if unchanged and self._ap_refresh_fraction > 0:
+            count = math.ceil(len(macs) * self._ap_refresh_fraction)
+            rolling = set(heapq.nsmallest(count, unchanged, key=lambda mac: self._ap_known[mac][2]))
+            fetch.extend(rolling)
+            self._ap_refreshes.labels('rolling').inc(len(rolling))
+
+        details = []
+        for mac in unchanged:
+            if mac in rolling:
+                continue
+            detail = self._ap_known[mac][1]
+            for d in AP_LIVE_FIELDS:
+                if BULK_AP_FIELDS[d] in rows[mac]:
+                    detail[d] = rows[mac][BULK_AP_FIELDS[d]]
+            details.append(detail)
+        self._ap_reuses.inc(len(details))
+
+        # Forget APs that were removed from the controller
+        current = set(macs)
+        self._ap_known = {mac: known for mac, known in self._ap_known.items() if mac in current}
+        return details, fetch
+
+    def internal_metrics(self):
+        # Exporter self-metrics, always current even when the API families come from a snapshot
+        for m in self._registry.collect():
             yield m
 
-        # Get APs list per zone or a domain
-        # For each APs captured from the query:
-        # - Grab the zone ID for labeling purposes
-        # - For each APs, get mac, zoneID, apGroupIdm, name, lanPortSize
-
-        ap_glob_mac = []
-        for ap in self.get_metrics(ap_list, 'aps')['list']:
-            zone_id = ap['zoneId']
-            ap_name = ap['name']
-            ap_mac = ap['mac']
-            ap_glob_mac.append(ap_mac)
-            for s in self._statuses:
-                # Export a dummy value for string-only metrics
-                extra = ap[s]
-                ap_list[s].add_metric([zone_id, ap_name, ap_mac, extra], 1)
-
-
-
-
-        for m in ap_list.values():
+    def scrape(self, sections=None):
+        for section, m in self.scrape_sections(sections):
             yield m
 
+    def scrape_sections(self, sections=None):
+        # Yield (section, family) pairs of the given sections, all enabled sections by default
+        # Families that belong to no section, like smartzone_collector_success, come with None
+        collection_start = time.monotonic()
+        enabled = self.sections if sections is None else sections
+        needed = set(enabled)
+        for name in enabled:
+            if name != 'ap_detail' or self._ap_detail_mode != 'bulk':
+                needed.update(SECTION_DEPENDENCIES.get(name, ()))
+
+        # With the asyncio engine, fetch every endpoint concurrently before building the metrics
+        # The responses belong to this scrape only, concurrent scrapes each read their own
+        prefetched = {}
+        if self._engine is not None:
+            # Both client sections read query/client, it is only fetched once
+            list_paths = list(collections.OrderedDict.fromkeys(
+                path for name, path in SECTION_LISTS.items() if name in needed))
+            if 'ap_detail' in needed and self._ap_detail_mode in ('bulk', 'incremental'):
+                list_paths.append('query/ap')
+            object_paths = ['system/devicesSummary'] if 'system_summary' in needed else []
+            prefetched = self._engine.prefetch(
+                list_paths, object_paths, statistics=('system' in needed),
+                ap_summaries=('ap_detail' in needed and self._ap_detail_mode == 'per-ap'))
+
+        # Each section below is collected on its own, a failing endpoint only drops the metrics of its section
+        # Values later sections depend on are passed through `state`
+        state = {}
+        # The AP sections keep compact records in one table, from which their samples are generated lazily
+        table = APTable()
+
+        def controller():
+            # Get SmartZone controller metrics
+            # Every node of the cluster is listed, the leader's id labels the cluster-wide system summary
+            families = METRIC_MAPS['controller'].families()
+            ids = []
+            for c in self.get_list('controller', prefetched):
+                METRIC_MAPS['controller'].add(families, c)
+                ids.append(c['id'])
+                if c.get('clusterRole') == 'Leader' or 'controller_id' not in state:
+                    state['controller_id'] = c['id']
+            state['controller_ids'] = ids
+            return families.values()
+
+        def system():
+            # Get SmartZone system metrics of every cluster node, fetched concurrently
+            ids = requires('controller_ids', 'controller')
+            paths = ['controller/' + id + '/statistics' for id in ids]
+            errors = []
+            if self._engine is not None:
+                # Statistics were prefetched with the controller list
+                results = [self.try_get_metrics(path, prefetched, errors) for path in paths]
+            else:
+                results = list(self._executor.map(lambda path: self.try_get_metrics(path, errors=errors), paths))
+
+            # Nodes whose statistics failed are left out, the others are still exported
+            metric_map = METRIC_MAPS['system']
+            families = metric_map.families()
+            for id, statistics in zip(ids, results):
+                if statistics:
+                    metric_map.add(families, statistics[0], [id])
+            for m in families.values():
+                yield m
 
-       # Get WLANs list per zone or a domain
-        for wlan in self.get_metrics(wlan_list, 'query/wlan')['list']:
-            wlan_name = wlan['name']
-            zone_id = wlan['zoneId']
-            for w in self._statuses:
-                if wlan.get(w) == None:
-                    wlan.update({w: 0})
-                if w == 'traffic' or w == 'trafficUplink' or w == 'trafficDownlink' or w == 'clients' or w == 'vlan':
-                    wlan_list[w].add_metric([zone_id, wlan_name, extra], wlan.get(w))
+            if errors:
+                raise RuntimeError('{} of {} controller statistics failed, the first with {}: {}: {}'.format(
+                    len(errors), len(paths), errors[0][0], type(errors[0][1]).__name__, errors[0][1]))
+
+        def system_summary():
+            # Ges SmartZone system summary
+            id = requires('controller_id', 'controller')
+            return METRIC_MAPS['system_summary'].build([self.get_metrics('system/devicesSummary', prefetched)], [id])
+
+        def aps():
+            # Get APs list per zone or a domain, and remember the MACs for the AP details
+            # Sharded, only the APs of this shard are exported and have their details fetched
+            record = METRIC_MAPS['aps'].record
+            ap_glob_mac = []
+            for ap in self.get_list('aps', prefetched):
+                if not self.in_shard(ap['mac']):
+                    continue
+                table.add('aps', ap['mac'], record(ap))
+                ap_glob_mac.append(ap['mac'])
+            state['ap_macs'] = ap_glob_mac
+            if self._shard_aps is not None:
+                self._shard_aps.set(len(ap_glob_mac))
+            return METRIC_MAPS['aps'].lazy(table.records('aps'))
+
+        def lineman():
+            record = METRIC_MAPS['lineman'].record
+            for ap in self.get_list('aps/lineman', prefetched):
+                if self.in_shard(ap['mac']):
+                    table.add('lineman', ap['mac'], record(ap))
+            return METRIC_MAPS['lineman'].lazy(table.records('lineman'))
+
+        def listed(section):
+            # Sections built from every entity of their list endpoint
+            return METRIC_MAPS[section].build(self.get_list(SECTION_LISTS[section], prefetched))
+
+        def client_list():
+            # Get client list and aggregate it for both client sections in one pass
+            # Clients are aggregated page by page, the full client list is never held in memory
+            if 'clients' not in state:
+                aggregator = ClientAggregator(vlans='clients_vlan' in needed, distributions='clients' in needed)
+                try:
+                    for client in self.get_list('query/client', prefetched):
+                        aggregator.add(client)
+                except Exception as e:
+                    # The list is not fetched twice, the second client section fails the same way
+                    state['clients'] = e
+                    raise
+                state['clients'] = aggregator
+            if isinstance(state['clients'], Exception):
+                raise state['clients']
+            return state['clients']
+
+        def clients_vlan():
+            return client_list().vlan_families()
+
+        def clients():
+            return client_list().distribution_families()
+
+        def ap_detail():
+            # In bulk mode, only APs that query/ap cannot fully describe are fetched one by one
+            # In incremental mode, only APs that changed since their last fetch, plus a rolling slice
+            if self._ap_detail_mode == 'bulk':
+                ap_details, ap_fetch_mac = self.get_bulk_ap_details(prefetched)
+            elif self._ap_detail_mode == 'incremental':
+                ap_details, ap_fetch_mac = self.get_incremental_ap_details(requires('ap_macs', 'aps'), prefetched)
+            else:
+                ap_details, ap_fetch_mac = [], requires('ap_macs', 'aps')
+
+            paths = ['aps/' + item + '/operational/summary' for item in ap_fetch_mac]
+            errors = []
+            if self._engine is not None:
+                # Summaries were prefetched with the aps list in per-AP mode, the other modes fetch them here
+                prefetched.update(self._engine.fetch_objects(
+                    [path for path in paths if path not in prefetched and not self._cache.fresh(path)]))
+                results = [self.try_get_metrics(path, prefetched, errors) for path in paths]
+            else:
+                # Fan out over the worker pool, which is shared by all targets in multi-target mode
+                results = self.map_window(lambda path: self.try_get_metrics(path, errors=errors), paths)
+
+            # Details are reduced to their records as they come in, the summaries are not kept
+            record = METRIC_MAPS['ap_detail'].record
+            for ap_detail in ap_details:
+                table.add('ap_detail', ap_detail['mac'], record(ap_detail))
+            del ap_details
+
+            # APs whose summary failed are left out, the others are still exported
+            refreshed_at = time.monotonic()
+            for item, ap_detail in zip(ap_fetch_mac, results):
+                if ap_detail is None:
+                    continue
+                table.add('ap_detail', ap_detail['mac'], record(ap_detail))
+                if self._ap_detail_mode == 'bulk' and ap_detail.get('mac') is not None:
+                    self._ap_static[ap_detail['mac']] = {d: ap_detail.get(d) for d in PER_AP_ONLY_FIELDS}
+                elif self._ap_detail_mode == 'incremental':
+                    # Only the fields of the AP detail metrics are remembered
+                    ap_detail = {d: ap_detail[d] for d in AP_DETAIL_FIELDS if d in ap_detail}
+                    self._ap_known[item] = (self._ap_fingerprints.get(item), ap_detail, refreshed_at)
+
+            for m in METRIC_MAPS['ap_detail'].lazy(table.records('ap_detail')):
+                yield m
 
-                # Export a dummy value for string-only metrics
+            # Raised after the metrics were yielded, so the section is reported as failed but keeps its APs
+            # and logs one line for all of them
+            if errors:
+                raise RuntimeError('{} of {} AP summaries failed, the first with {}: {}: {}'.format(
+                    len(errors), len(paths), errors[0][0], type(errors[0][1]).__name__, errors[0][1]))
+
+        def alarms():
+            # The first read only finds the newest alarm, new alarms are read from there on
+            # The alarms that are not cleared are read again every alarm_resync seconds, at most alarm_index_size
+            with self._alerts_lock:
+                if self._alarms.cursor.position is None:
+                    self._alarms.start(self.query_page('alert/alarm/list', ALERT_LATEST))
                 else:
-                    extra = wlan[w]
-                    wlan_list[w].add_metric([zone_id, wlan_name, extra], 1)
-
-        # Get client list and calculate VLAN client count
-        import collections
-        clients = self.get_metrics({}, 'query/client')['list']
-        vlan_totals = collections.Counter()
-        vlan_ssid_totals = collections.Counter()
-        for client in clients:
-            vlan = client.get('vlan') or client.get('accessVlan')
-            ssid = client.get('ssid')
-            zone_id = client.get('zoneId')
-            if vlan is None or zone_id is None:
+                    self._alarms.update(self.query_list('alert/alarm/list',
+                                                        alert_criteria(self._alarms.cursor.position)))
+                if self._alarms.resync_due():
+                    self._alarms.resync(itertools.islice(self.query_list('alert/alarm/list', ALARMS_NOT_CLEARED),
+                                                         self._alarms.size))
+                return self._alarms.families()
+
+        def events():
+            # The first read only finds the newest event, from which events are counted
+            with self._alerts_lock:
+                if self._events.cursor.position is None:
+                    self._events.start(self.query_page('alert/event/list', ALERT_LATEST))
+                else:
+                    self._events.update(self.query_list('alert/event/list',
+                                                        alert_criteria(self._events.cursor.position)))
+                return self._events.families()
+
+        def requires(key, section):
+            if key not in state:
+                raise RuntimeError('depends on the {} section, which failed'.format(section))
+            return state[key]
+
+        section_success = GaugeMetricFamily('smartzone_collector_success',
+                                            'Whether a section of the collection succeeded', labels=["section"])
+        section_duration = GaugeMetricFamily('smartzone_collector_duration_seconds',
+                                             'Duration of a section of the collection', labels=["section"])
+        collectors = {'controller': controller, 'system': system, 'system_summary': system_summary,
+                      'aps': aps, 'clients_vlan': clients_vlan, 'clients': clients, 'ap_detail': ap_detail,
+                      'lineman': lineman, 'alarms': alarms, 'events': events}
+        # MAC -> smartzone_ap_info labels, gathered from the AP sections
+        ap_info = {} if self._ap_info else None
+        # The scrape fails as a whole when the controller section fails, the login is rejected, or the first section
+        # cannot reach the controller at all. The remaining sections are then failed without their requests.
+        failure = None
+        reached = False
+        skipped = []
+        for name in SECTIONS:
+            if name not in needed:
                 continue
-            vlan = str(vlan)
-            zone_id = str(zone_id)
-            vlan_totals[(zone_id, vlan)] += 1
-            if ssid:
-                vlan_ssid_totals[(zone_id, vlan, ssid)] += 1
-        for (zone_id, vlan_id), total in vlan_totals.items():
-            vlan_totals_metric.add_metric([zone_id, vlan_id], total)
-        for (zone_id, vlan_id, ssid), count in vlan_ssid_totals.items():
-            vlan_ssid_metric.add_metric([zone_id, vlan_id, ssid], count)
-        yield vlan_totals_metric
-        yield vlan_ssid_metric
+            if failure is not None:
+                skipped.append(name)
+                section_success.add_metric([name], 0)
+                section_duration.add_metric([name], 0)
+                continue
+            start = time.monotonic()
+            success = 1
+            try:
+                section = collectors[name]() if name in collectors else listed(name)
+                for m in section:
+                    # Sections only collected for a dependency are not exported
+                    if name not in enabled:
+                        continue
+                    if ap_info is not None and m.name in AP_INFO_FAMILIES:
+                        fold_ap_info(ap_info, m)
+                    else:
+                        m = self._budget.apply(m)
+                        yield name, m
+                        rate = self._rates.observe(m, time.monotonic())
+                        if rate is not None:
+                            yield name, rate
+            except Exception as e:
+                success = 0
+                print('Collection of {} from {} failed: {!r}'.format(name, self._target, e))
+                if name == 'controller' or isinstance(e, LoginError) or (unreachable_error(e) and not reached):
+                    failure = e
+            reached = reached or success == 1
+            section_success.add_metric([name], success)
+            section_duration.add_metric([name], time.monotonic() - start)
+        yield None, section_success
+        yield None, section_duration
+
+        if ap_info is not None:
+            info_metric = GaugeMetricFamily('smartzone_ap_info', 'SmartZone AP information', labels=AP_INFO_LABELS)
+            for mac, labels in ap_info.items():
+                info_metric.add_metric([mac] + [labels.get(label, '') for label in AP_INFO_LABELS[1:]], 1)
+            # Served with the first AP section that is enabled, so collect[] selects it like that section
+            section = next((name for name in ('aps', 'ap_detail', 'lineman') if name in enabled), None)
+            if section is not None:
+                yield section, self._budget.apply(info_metric)
+
+        self._collection_duration.observe(time.monotonic() - collection_start)
+        if skipped:
+            print('Skipped the {} sections of {}'.format(', '.join(skipped), self._target))
+        if failure is not None:
+            raise RuntimeError('Collection from {} failed: {!r}'.format(self._target, failure))
+
+
+# Snapshot state files: gzip-compressed JSON, so loading one can never run code
+STATE_FORMAT = 1
+
+
+def dump_families(pairs):
+    # (section, family) pairs as JSON-compatible lists
+    return [[section, family.name, family.documentation, family.type, family.unit,
+             [[sample.name, sample.labels, sample.value] for sample in family.samples]]
+            for section, family in pairs]
+
+
+def load_families(data):
+    pairs = []
+    for section, name, documentation, kind, unit, samples in data:
+        family = Metric(name, documentation, kind, unit)
+        family.samples = [Sample(sample_name, {label: intern_label(value) for label, value in labels.items()},
+                                 value, None)
+                          for sample_name, labels, value in samples]
+        pairs.append((section, family))
+    return pairs
+
+
+def write_state(path, data):
+    # Written to a temporary file next to the target and renamed over it, so a crash never leaves half a file
+    # mkstemp creates the file readable by the exporter's user only, it may hold the API session cookie
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=3, mtime=0) as z:
+                z.write(json.dumps(data, separators=(',', ':')).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def state_path(directory, instance, shard=None):
+    # One state file per target and shard, named after them
+    name = instance if shard is None else '{}-shard{}'.format(instance, shard)
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9._-]+', '_', name) + '.json.gz')
+
+
+# Background poller - runs the collector on a fixed interval and keeps the last complete snapshot
+# so that Prometheus scrapes are served from memory instead of hitting the SmartZone API
+class SmartZonePoller(threading.Thread):
+
+    def __init__(self, collector, interval, pusher=None, instance=None, state_dir=None):
+        # Daemon thread so a keyboard interrupt in main() is not blocked by an in-flight poll
+        super().__init__(daemon=True)
+        self._collector = collector
+        self._interval = interval
+        # Completed snapshots are also pushed, labelled with the instance, when a pusher is given
+        self._pusher = pusher
+        self._instance = instance or collector._target
+        # Replicas of a sharded deployment push the same instance, told apart by their shard
+        self._labels = {'instance': self._instance}
+        self._shard = None
+        if collector._shard_count > 1:
+            self._shard = [collector._shard_index, collector._shard_count]
+            self._labels['shard'] = str(collector._shard_index)
+
+        # Snapshot is a ([(section, family)], finished_at, duration) tuple, replaced as a whole after each poll
+        # A single attribute assignment is atomic, so collect() never sees a half-built snapshot
+        self._snapshot = None
+        self._polls = 0
+        self._poll_errors = 0
+        self._last_duration = 0
+        self._last_success = True
+
+        # The last good snapshot is saved after every poll, and served right away after a restart
+        # until the first poll of the new process completes
+        self._state_path = None
+        if state_dir is not None:
+            self._state_path = state_path(state_dir, self._instance, None if self._shard is None else self._shard[0])
+        self._restored = False
+        self._state_errors = 0
+        if self._state_path is not None and os.path.exists(self._state_path):
+            try:
+                self.load_state()
+            except Exception as e:
+                self._state_errors += 1
+                print('Loading state of {} from {} failed: {!r}'.format(self._instance, self._state_path, e))
+
+    def load_state(self):
+        with gzip.open(self._state_path, 'rb') as f:
+            data = json.loads(f.read())
+        if data.get('format') != STATE_FORMAT or data.get('target') != self._collector._target:
+            raise ValueError('state file is of another format or target')
+        if data.get('shard') != self._shard:
+            raise ValueError('state file is of another shard')
+        downtime = max(0, time.time() - data['saved_at'])
+        self._collector.restore_state(data['collector'], downtime)
+        # Sections that were disabled since are not served
+        families = [(section, family) for section, family in load_families(data['families'])
+                    if section is None or section in self.sections]
+        self._snapshot = (families, data['finished_at'], data['duration'])
+        self._restored = True
+        print('Restored the snapshot of {} from {}, collected {:.0f} seconds ago'.format(
+            self._instance, self._state_path, time.time() - data['finished_at']))
+
+    def save_state(self):
+        families, finished_at, duration = self._snapshot
+        write_state(self._state_path, {'format': STATE_FORMAT, 'target': self._collector._target,
+                                       'shard': self._shard, 'saved_at': time.time(), 'finished_at': finished_at,
+                                       'duration': duration, 'families': dump_families(families),
+                                       'collector': self._collector.state()})
+
+    @property
+    def sections(self):
+        return self._collector.sections
+
+    def has_snapshot(self):
+        return self._snapshot is not None
+
+    def healthy(self):
+        # A snapshot is served and the last poll reached the controller
+        return self._snapshot is not None and self._last_success
+
+    @property
+    def version(self):
+        # Changes whenever the polled data changes, rendered expositions are reused until then
+        return self._polls
+
+    def poll(self):
+        start = time.time()
+        snapshot = None
+        try:
+            # Materialise the generator so the complete set of families is built before the swap
+            # A poll that could not log in or collect the controller section raises, the previous snapshot
+            # is then kept, and neither pushed nor saved again
+            families = list(self._collector.scrape_sections())
+        except Exception as e:
+            self._poll_errors += 1
+            print('Poll of {} failed: {}'.format(self._collector._target, e))
+        else:
+            snapshot = self._snapshot = (families, time.time(), time.time() - start)
+            self._restored = False
+        self._last_success = snapshot is not None
+        self._last_duration = time.time() - start
+        # Counted last, so a version read before rendering never comes with an older snapshot
+        self._polls += 1
+        if self._pusher is not None and snapshot is not None:
+            self._pusher.submit(list(self.collect()), snapshot[1], self._labels)
+        if self._state_path is not None and snapshot is not None:
+            try:
+                self.save_state()
+            except Exception as e:
+                self._state_errors += 1
+                print('Saving state of {} to {} failed: {!r}'.format(self._instance, self._state_path, e))
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            self.poll()
+            # Keep a fixed cadence: sleep only for what is left of the interval
+            time.sleep(max(0, self._interval - (time.monotonic() - start)))
+
+    def snapshot_families(self, sections=None):
+        # Every enabled section is polled, collect[] only filters the snapshot
+        snapshot = self._snapshot
+        if snapshot is not None:
+            for section, m in snapshot[0]:
+                if section is None or sections is None or section in sections:
+                    yield m
+
+    def collect(self, sections=None, snapshot=True):
+        # snapshot=False leaves out the families of the snapshot, and only yields the metrics that change
+        # between polls, for expositions that render the snapshot once per poll
+        if snapshot:
+            for m in self.snapshot_families(sections):
+                yield m
 
-        for w in wlan_list.values():
-            yield w
+        snapshot = self._snapshot
+        if snapshot is not None:
+            families, finished_at, duration = snapshot
+            age = GaugeMetricFamily('smartzone_snapshot_age_seconds',
+                                    'Seconds since the served snapshot was collected')
+            age.add_metric([], time.time() - finished_at)
+            yield age
+
+            timestamp = GaugeMetricFamily('smartzone_snapshot_timestamp_seconds',
+                                          'Unix time the served snapshot was collected')
+            timestamp.add_metric([], finished_at)
+            yield timestamp
+
+            snapshot_duration = GaugeMetricFamily('smartzone_snapshot_duration_seconds',
+                                                  'Duration of the poll that produced the served snapshot')
+            snapshot_duration.add_metric([], duration)
+            yield snapshot_duration
+
+            restored = GaugeMetricFamily('smartzone_snapshot_restored',
+                                         'Whether the served snapshot was loaded from the state file at startup')
+            restored.add_metric([], 1 if self._restored else 0)
+            yield restored
+
+        last_duration = GaugeMetricFamily('smartzone_poll_duration_seconds',
+                                          'Duration of the last poll, successful or not')
+        last_duration.add_metric([], self._last_duration)
+        yield last_duration
+
+        last_success = GaugeMetricFamily('smartzone_poll_success',
+                                         'Whether the last poll succeeded and replaced the snapshot')
+        last_success.add_metric([], 1 if self._last_success else 0)
+        yield last_success
+
+        polls = CounterMetricFamily('smartzone_polls',
+                                    'Total number of background polls')
+        polls.add_metric([], self._polls)
+        yield polls
+
+        poll_errors = CounterMetricFamily('smartzone_poll_errors',
+                                          'Total number of background polls that failed')
+        poll_errors.add_metric([], self._poll_errors)
+        yield poll_errors
+
+        if self._state_path is not None:
+            state_errors = CounterMetricFamily('smartzone_state_errors',
+                                               'Total number of failures to load or save the state file')
+            state_errors.add_metric([], self._state_errors)
+            yield state_errors
+
+        for m in self._collector.internal_metrics():
+            yield m
 
 
+# Protobuf wire format, enough of it to encode a remote_write WriteRequest without the protobuf package
+def pb_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def pb_bytes(field, data):
+    # Length-delimited field: strings and embedded messages
+    return pb_varint(field << 3 | 2) + pb_varint(len(data)) + data
+
+
+def remote_write_batches(families, timestamp, labels, batch_size):
+    # Yield (snappy-compressed WriteRequest, series) with at most batch_size series each
+    #   WriteRequest { repeated TimeSeries timeseries = 1; }
+    #   TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+    #   Label { string name = 1; string value = 2; }  Sample { double value = 1; int64 timestamp = 2; }
+    series = []
+    for family in families:
+        for sample in family.samples:
+            # Labels must be sorted by name, __name__ included
+            pairs = sorted(dict(labels, __name__=sample.name, **sample.labels).items())
+            milliseconds = int((sample.timestamp or timestamp) * 1000)
+            data = b''.join(pb_bytes(1, pb_bytes(1, name.encode()) + pb_bytes(2, value.encode()))
+                            for name, value in pairs)
+            data += pb_bytes(2, b'\x09' + struct.pack('<d', sample.value) + b'\x10' + pb_varint(milliseconds))
+            series.append(pb_bytes(1, data))
+            if len(series) >= batch_size:
+                yield snappy.compress(b''.join(series)), len(series)
+                series = []
+    if series:
+        yield snappy.compress(b''.join(series)), len(series)
+
+
+def otlp_double(value):
+    # The JSON encoding of OTLP spells out non-finite doubles as strings
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return value
+
+
+def otlp_attributes(labels):
+    return [{'key': name, 'value': {'stringValue': value}} for name, value in labels.items()]
+
+
+def otlp_points(family, time_ns):
+    # Yield (name, kind, data points) of a family, the kind being gauge, sum or histogram
+    # Counters become monotonic cumulative sums, histograms get their buckets de-accumulated
+    if family.type == 'counter':
+        yield family.name, 'sum', [{'attributes': otlp_attributes(s.labels), 'timeUnixNano': time_ns,
+                                    'asDouble': otlp_double(s.value)}
+                                   for s in family.samples if s.name.endswith('_total')]
+    elif family.type == 'histogram':
+        series = collections.OrderedDict()
+        for s in family.samples:
+            labels = {name: value for name, value in s.labels.items() if name != 'le'}
+            entry = series.setdefault(tuple(sorted(labels.items())), {'labels': labels, 'buckets': []})
+            if s.name.endswith('_bucket'):
+                entry['buckets'].append((float(s.labels['le']), s.value))
+            elif s.name.endswith('_sum') or s.name.endswith('_count'):
+                entry[s.name.rsplit('_', 1)[1]] = s.value
+        points = []
+        for entry in series.values():
+            buckets = sorted(entry['buckets'])
+            counts = [count - previous for (_, count), (_, previous) in zip(buckets, [(None, 0)] + buckets[:-1])]
+            points.append({'attributes': otlp_attributes(entry['labels']), 'timeUnixNano': time_ns,
+                           'count': str(int(entry.get('count', buckets[-1][1] if buckets else 0))),
+                           'sum': otlp_double(entry.get('sum', 0)),
+                           'bucketCounts': [str(int(count)) for count in counts],
+                           'explicitBounds': [bound for bound, _ in buckets if not math.isinf(bound)]})
+        yield family.name, 'histogram', points
+    else:
+        gauges = collections.OrderedDict()
+        for s in family.samples:
+            gauges.setdefault(s.name, []).append({'attributes': otlp_attributes(s.labels), 'timeUnixNano': time_ns,
+                                                  'asDouble': otlp_double(s.value)})
+        for name, points in gauges.items():
+            yield name, 'gauge', points
+
+
+def otlp_batches(families, timestamp, labels, batch_size):
+    # Yield (OTLP/HTTP JSON ExportMetricsServiceRequest, data points) with about batch_size data points each
+    # job and instance become the service.name and service.instance.id resource attributes,
+    # further labels resource attributes of their own name
+    attributes = dict(labels, **{'service.name': labels['job'], 'service.instance.id': labels['instance']})
+    del attributes['job'], attributes['instance']
+    resource = {'attributes': otlp_attributes(attributes)}
+    time_ns = str(int(timestamp * 1e9))
+
+    def request(metrics):
+        return json.dumps({'resourceMetrics': [{'resource': resource, 'scopeMetrics': [
+            {'scope': {'name': 'smartzone_exporter'}, 'metrics': metrics}]}]}).encode()
+
+    metrics = []
+    size = 0
+    for family in families:
+        for name, kind, points in otlp_points(family, time_ns):
+            for start in range(0, len(points), batch_size):
+                data = {'dataPoints': points[start:start + batch_size]}
+                if kind != 'gauge':
+                    data['aggregationTemporality'] = 2
+                if kind == 'sum':
+                    data['isMonotonic'] = True
+                metrics.append({'name': name, 'description': family.documentation, kind: data})
+                size += len(data['dataPoints'])
+                if size >= batch_size:
+                    yield request(metrics), size
+                    metrics = []
+                    size = 0
+    if metrics:
+        yield request(metrics), size
+
+
+# Encoder and request headers of each push format
+PUSH_FORMATS = {
+    'remote_write': (remote_write_batches, {'Content-Type': 'application/x-protobuf', 'Content-Encoding': 'snappy',
+                                            'X-Prometheus-Remote-Write-Version': '0.1.0'}),
+    'otlp': (otlp_batches, {'Content-Type': 'application/json'}),
+}
 
-        num_worker_threads = 10
+# Longest wait between attempts to push the oldest queued snapshot
+PUSH_MAX_BACKOFF = 60
+
+
+class SmartZonePusher(threading.Thread):
+    # Pushes completed poller snapshots to a remote_write or OTLP endpoint
+    # Snapshots wait in a bounded queue: while the endpoint is down the oldest one is retried with backoff,
+    # and once the queue is full the oldest snapshot is dropped to make room.
+    # A snapshot that fails with anything but a request error is dropped instead of retried
+
+    def __init__(self, url, format='remote_write', job='smartzone', headers=None, batch_size=5000, queue_size=10,
+                 timeout=30, retry_backoff=0.5):
+        super().__init__(daemon=True)
+        self._url = url
+        self._encode, self._headers = PUSH_FORMATS[format]
+        self._headers = dict(self._headers, **(headers or {}))
+        self._job = job
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._retry_backoff = retry_backoff
+        self._session = requests.Session()
+        # Queued snapshots are [families, timestamp, labels, batches already sent]
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._condition = threading.Condition()
+
+        self._registry = CollectorRegistry(auto_describe=True)
+        Gauge('smartzone_push_queue_snapshots', 'Snapshots waiting to be pushed',
+              registry=self._registry).set_function(lambda: len(self._queue))
+        Gauge('smartzone_push_lag_seconds', 'Age of the oldest snapshot waiting to be pushed',
+              registry=self._registry).set_function(self._lag)
+        self._dropped = Counter('smartzone_push_snapshots_dropped', 'Snapshots dropped because the push queue was full',
+                                registry=self._registry)
+        self._failed = Counter('smartzone_push_snapshots_failed',
+                               'Snapshots dropped because encoding or pushing them raised an unexpected error',
+                               registry=self._registry)
+        self._requests = Counter('smartzone_push_requests', 'Push requests by HTTP status code or error',
+                                 ['code'], registry=self._registry)
+        self._retries = Counter('smartzone_push_retries', 'Push requests retried after a failure',
+                                registry=self._registry)
+        self._samples = Counter('smartzone_push_samples', 'Samples accepted by the push endpoint',
+                                registry=self._registry)
+        self._rejected = Counter('smartzone_push_samples_rejected',
+                                 'Samples dropped because the push endpoint rejected them', registry=self._registry)
+        self._duration = Histogram('smartzone_push_request_duration_seconds', 'Duration of push requests',
+                                   registry=self._registry)
+
+    def _lag(self):
+        queue = list(self._queue)
+        return time.time() - queue[0][1] if queue else 0
 
-        def source():
-            return ap_glob_mac
+    def collect(self):
+        return self._registry.collect()
+
+    def submit(self, families, timestamp, labels):
+        # labels: instance, and shard when sharded, added to every pushed series
+        with self._condition:
+            self._queue.append([families, timestamp, dict(labels, job=self._job), 0])
+            while len(self._queue) > self._queue_size:
+                self._queue.popleft()
+                self._dropped.inc()
+            self._condition.notify()
+
+    def run(self):
+        failures = 0
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                item = self._queue[0]
+            try:
+                self.push(item)
+            except requests.RequestException as e:
+                # The snapshot stays queued, and is resumed after the batches that were already sent
+                failures += 1
+                self._retries.inc()
+                print('Push to {} failed: {}'.format(self._url, e))
+                time.sleep(min(self._retry_backoff * 2 ** (failures - 1), PUSH_MAX_BACKOFF))
+                continue
+            except Exception as e:
+                # Any other error would fail again on every retry, the snapshot is dropped and the thread goes on
+                self._failed.inc()
+                print('Push to {} failed, snapshot dropped: {}: {}'.format(self._url, type(e).__name__, e))
+            failures = 0
+            with self._condition:
+                # The snapshot may have been dropped from a full queue while it was pushed
+                if self._queue and self._queue[0] is item:
+                    self._queue.popleft()
+
+    def push(self, item):
+        families, timestamp, labels, sent = item
+        for body, samples in itertools.islice(self._encode(families, timestamp, labels, self._batch_size), sent, None):
+            start = time.monotonic()
+            try:
+                r = self._session.post(self._url, data=body, headers=self._headers, timeout=self._timeout)
+            except requests.RequestException as e:
+                self._requests.labels(type(e).__name__).inc()
+                raise
+            finally:
+                self._duration.observe(time.monotonic() - start)
+            self._requests.labels(str(r.status_code)).inc()
+            if r.status_code in RETRY_STATUSES:
+                raise requests.HTTPError('{} {}'.format(r.status_code, r.reason), response=r)
+            if r.status_code >= 400:
+                # Retrying a rejected batch cannot succeed, like Prometheus it is dropped
+                print('Push to {} rejected: {} {}'.format(self._url, r.status_code, r.text[:200]))
+                self._rejected.inc(samples)
+            else:
+                self._samples.inc(samples)
+            item[3] += 1
+
+
+# Collector options that can be set per module or target in the --config file, with their type
+CONFIG_OPTIONS = {
+    'session_ttl': int,
+    'page_size': int,
+    'page_concurrency': int,
+    'ap_detail_mode': parse_choice(AP_DETAIL_MODES),
+    'ap_refresh_fraction': float,
+    'json_parser': parse_choice(JSON_PARSERS),
+    'engine': parse_choice(ENGINES),
+    'max_concurrency': int,
+    'rate_limit': float,
+    'rate_burst': int,
+    'endpoint_rate_limits': lambda value: parse_endpoint_values([value]),
+    'cache_ttls': lambda value: dict(DEFAULT_CACHE_TTLS, **parse_endpoint_values([value])),
+    'cache_size': int,
+    'timeout': float,
+    'retries': int,
+    'retry_backoff': float,
+    'sections': parse_sections,
+    'drop_labels': str,
+    'allow_labels': str,
+    'max_series': int,
+    'ap_info': parse_bool,
+    'rate_samples': int,
+    'coalesce_window': float,
+    'shard_index': int,
+    'shard_count': int,
+    'alarm_index_size': int,
+    'alarm_resync': float,
+}
 
-        def worker():
-            while True:
-                item = q.get()
-                if item is None:
-                    break
-                path = 'aps/' + item + '/operational/summary'
-                r.put(self.get_metrics(ap_metrics, path))
-                q.task_done()
-
-        # Queue for threads
-        q = queue.Queue()
-
-        # Queue for result from api
-        r = queue.Queue()
-
-        threads = []
-
-        for i in range(num_worker_threads):
-            t = threading.Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        for item in source():
-            q.put(item)
-
-        # block until all tasks are done
-        q.join()
-
-        # stop workers
-        for i in range(num_worker_threads):
-            q.put(None)
-
-        for t in threads:
-            t.join()
-
-        ap_mac = 0
-        for i in range(r.qsize()):
-            ap_detail = r.get(block=True, timeout=None)
-            for d in list(ap_metrics.keys()):
-                if (d == "description") & (ap_detail.get("description") == None):
-                    ap_detail.update({"description": "None"})
-                elif ap_detail.get(d) == None:
-                    ap_detail.update({d: 0})
-                if d == 'mac':
-                    ap_mac = ap_detail[d]
-                if d == 'description' or d == 'version' or d == 'model' or d == 'zoneId' or d == 'mac' or d == 'connectionState':
-                    extra = ap_detail[d]
-                    ap_metrics[d].add_metric([ap_mac, extra], 1)
-                else:
-                    ap_metrics[d].add_metric([ap_mac], ap_detail.get(d))
 
-        for m in ap_metrics.values():
-            yield m
+def check_options(options, flag=str):
+    # Checks of collector options that involve optional packages or other options, for the command line
+    # and the config file, raising ValueError. `flag` names an option in the messages.
+    if options.get('engine') == 'asyncio' and aiohttp is None:
+        raise ValueError('{} asyncio requires the aiohttp package'.format(flag('engine')))
+    if options.get('json_parser') == 'orjson' and orjson is None:
+        raise ValueError('{} orjson requires the orjson package'.format(flag('json_parser')))
+    if options.get('json_parser') == 'stream' and ijson is None:
+        raise ValueError('{} stream requires the ijson package'.format(flag('json_parser')))
+    rate_samples = options.get('rate_samples', 0)
+    if rate_samples == 1 or rate_samples < 0:
+        raise ValueError('{} must be 0 or at least 2'.format(flag('rate_samples')))
+    shard_index, shard_count = options.get('shard_index', 0), options.get('shard_count', 1)
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError('{} must be between 0 and {} - 1'.format(flag('shard_index'), flag('shard_count')))
+    for option in ('drop_labels', 'allow_labels'):
+        try:
+            re.compile(options.get(option) or '')
+        except re.error as e:
+            raise ValueError('{} is not a valid regex: {}'.format(flag(option), e))
+
+
+def load_config(path, defaults):
+    # Read the multi-target config file
+    #   [module:<name>]  credentials and collector options shared by the targets probed with this module
+    #   [target:<name>]  url of one controller, plus options overriding those of the module
+    # Returns ({module: options}, {target: options}), each options dict starting from `defaults`
+    parser = configparser.ConfigParser(interpolation=None)
+    if not parser.read(path):
+        raise ValueError('Cannot read config file {}'.format(path))
+
+    def options(section):
+        result = {}
+        for key in section:
+            if key in ('user', 'password', 'url', 'module'):
+                result[key] = section[key]
+            elif key == 'verify_ssl':
+                result['insecure'] = section.getboolean(key)
+            elif key in CONFIG_OPTIONS:
+                try:
+                    result[key] = CONFIG_OPTIONS[key](section[key])
+                except ValueError as e:
+                    raise ValueError('Invalid {} in [{}]: {}'.format(key, section.name, e))
+            else:
+                raise ValueError('Unknown option {} in [{}]'.format(key, section.name))
+        return result
 
-        # Get APs summary information
-        for ap in self.get_metrics(ap_summary_list, 'aps/lineman')['list']:
-            ap_name = ap['name']
-            ap_mac = ap['mac']
-            for s in self._statuses:
-                if s == 'criticalCount' or s == 'majorCount' or s == 'minorCount' or s == 'warningCount':
-                    ap_summary_list[s].add_metric([ap_name, ap_mac], ap['alarms'].get(s))
-                else:
-                    extra = ap[s]
-                    ap_summary_list[s].add_metric([ap_name, ap_mac, extra], 1)
+    modules = {}
+    targets = {}
+    for name in parser.sections():
+        kind, _, label = name.partition(':')
+        if kind == 'module':
+            modules[label] = dict(defaults, **options(parser[name]))
+        elif kind == 'target':
+            targets[label] = options(parser[name])
+            if 'url' not in targets[label]:
+                raise ValueError('Missing url in [{}]'.format(name))
+        else:
+            raise ValueError('Unknown section [{}], expected [module:<name>] or [target:<name>]'.format(name))
+
+    # Options are checked like on the command line, a target with those of its module
+    checks = [('module:' + label, module) for label, module in modules.items()]
+    for label, target in targets.items():
+        module = target.get('module', 'default')
+        if module not in modules and module != 'default':
+            raise ValueError('Unknown module {} in [target:{}]'.format(module, label))
+        checks.append(('target:' + label, dict(modules.get(module, defaults), **target)))
+    for name, options in checks:
+        try:
+            check_options(options)
+        except ValueError as e:
+            raise ValueError('Invalid options in [{}]: {}'.format(name, e))
+    return modules, targets
+
+
+# Targets served on /probe, with one collector (and session) per target and module
+class SmartZoneTargets():
+
+    def __init__(self, modules, targets, executor, interval=0, pusher=None, state_dir=None):
+        self._modules = modules
+        self._targets = targets
+        # Worker pool shared by every collector, bounding the threads of the whole exporter
+        self._executor = executor
+        self._interval = interval
+        self._pusher = pusher
+        self._state_dir = state_dir
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, target, module):
+        # Targets may be given by name or by url, but only configured controllers are probed
+        # so credentials are never sent to a url taken from the request
+        name = target if target in self._targets else None
+        for label, options in self._targets.items():
+            if name is None and options['url'].rstrip('/') == target.rstrip('/'):
+                name = label
+        if name is None:
+            raise KeyError('Unknown target {}'.format(target))
+        module = module or self._targets[name].get('module', 'default')
+        if module not in self._modules:
+            raise KeyError('Unknown module {}'.format(module))
+        return name, module
+
+    def get(self, target, module=None):
+        name, module = self.resolve(target, module)
+        with self._lock:
+            collector = self._collectors.get((name, module))
+            if collector is None:
+                options = dict(self._modules[module], **self._targets[name])
+                options.pop('module', None)
+                collector = SmartZoneCollector(options.pop('url'), options.pop('user', None),
+                                               options.pop('password', None), options.pop('insecure', True),
+                                               executor=self._executor, **options)
+                if self._interval > 0:
+                    # Each target is polled in the background once it has been probed
+                    collector = SmartZonePoller(collector, self._interval, self._pusher, name, self._state_dir)
+                    collector.start()
+                self._collectors[(name, module)] = collector
+        return collector
+
+    def probe(self, target, module=None, sections=None, snapshot=True):
+        # Collect one target into a list of families, with blackbox-style probe metrics
+        # snapshot=False leaves out the snapshot families of a polled target, see SmartZonePoller.collect()
+        collector = self.get(target, module)
+        check_sections(collector, sections)
+        start = time.time()
+        success = 1
+        try:
+            if isinstance(collector, SmartZonePoller):
+                families = list(collector.collect(sections, snapshot))
+                # The last good snapshot is still served, but a poll that failed fails the probe
+                success = 1 if collector.healthy() else 0
+            else:
+                families = list(collector.collect(sections))
+        except Exception as e:
+            print('Probe of {} failed: {}'.format(target, e))
+            families = []
+            success = 0
+
+        probe_success = GaugeMetricFamily('smartzone_probe_success', 'Whether the probe of the target succeeded')
+        probe_success.add_metric([], success)
+        probe_duration = GaugeMetricFamily('smartzone_probe_duration_seconds', 'Duration of the probe')
+        probe_duration.add_metric([], time.time() - start)
+        return families + [probe_success, probe_duration]
+
+
+def check_sections(collector, sections):
+    # Only sections enabled for a collector can be selected with collect[]
+    for name in sections or ():
+        if name not in collector.sections:
+            raise KeyError('Section {} is not enabled'.format(name))
+
+
+# The metrics of a poller that change between polls, registered in place of the poller
+# so that the HTTP handler can render its snapshot families once per poll
+class PollerMetrics():
+
+    def __init__(self, poller):
+        self._poller = poller
 
-        for m in ap_summary_list.values():
-            yield m
+    def collect(self):
+        return self._poller.collect(snapshot=False)
 
-        # Collect domain information
-        for c in self.get_metrics(domain_metrics, 'domains')['list']:
-            domain_id = c['id']
-            domain_name = c['name']
-            for s in self._statuses:
-                if s == 'domainType' or s == 'parentDomainId':
-                    extra = c[s]
-                    domain_metrics[s].add_metric([domain_id, domain_name, extra], 1)
-                else:
-                    domain_metrics[s].add_metric([domain_id, domain_name], c.get(s))
 
-        for m in domain_metrics.values():
-            yield m
+# Families wrapped as a registry, so they can be passed to the exposition encoders
+class StaticRegistry():
 
-        # Collect license information
-        for c in self.get_metrics(license_metrics, 'licenses')['list']:
-            license_name = c['name']
-            for s in self._statuses:
-                if s == 'count':
-                    license_metrics[s].add_metric([license_name], c.get(s))
-                else:
-                    extra = c[s]
-                    license_metrics[s].add_metric([license_name, extra], 1)
+    def __init__(self, families):
+        self._families = families
 
-        for m in license_metrics.values():
-            yield m
+    def collect(self):
+        return iter(self._families)
+
+
+# Expositions of the polled data, rendered once per version and served as bytes until the version changes
+# The ETag is weak: it stands for the polled data, the live metrics appended to every response still change
+class ExpositionCache():
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version, render, gzipped=False):
+        # Returns (body, etag) of the exposition, render() is only called when `version` was not rendered yet
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # Concurrent scrapes of the same key wait for one render instead of rendering in parallel
+        with lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['version'] != version:
+                body = render()
+                entry = {'version': version, 'body': body,
+                         'etag': 'W/"{}"'.format(hashlib.sha1(body).hexdigest()[:24])}
+                self._entries[key] = entry
+            if not gzipped:
+                return entry['body'], entry['etag']
+            # The gzip variant is compressed on first use, and needs an ETag of its own
+            if 'gzip' not in entry:
+                entry['gzip'] = gzip.compress(entry['body'], compresslevel=6)
+            return entry['gzip'], entry['etag'][:-1] + '-gzip"'
+
+
+def gzip_accepted(accept_encoding):
+    # Whether an Accept-Encoding header allows gzip, ignoring q-values other than q=0
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() == 'gzip':
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+# HTTP handler serving /metrics from the registry and /probe from the configured targets
+class SmartZoneHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    targets = None
+    # The -t target, collected directly when /metrics selects sections with collect[]
+    collector = None
+    # Rendered expositions of polled data, shared by all requests
+    expositions = None
+
+    def log_message(self, format, *args):
+        # Keep the exporter output for errors, not for every scrape
+        pass
+
+    def _send(self, status, body, content_type='text/plain; charset=utf-8', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_registry(self, registry, key=None, version=None, snapshot=None):
+        # `registry` is a registry or a function returning one, rendered for every request
+        # `snapshot` is a function returning a registry of polled data, whose exposition is rendered once per
+        # version and put in front of the live metrics of `registry`, with an ETag
+        encoder, content_type = choose_encoder(self.headers.get('Accept'))
+        gzipped = gzip_accepted(self.headers.get('Accept-Encoding'))
+        headers = [('Vary', 'Accept, Accept-Encoding')]
+        if gzipped:
+            headers.append(('Content-Encoding', 'gzip'))
+
+        def render_snapshot():
+            # Only the live part ends with the OpenMetrics EOF marker
+            body = encoder(snapshot())
+            return body[:-len(b'# EOF\n')] if body.endswith(b'# EOF\n') else body
+
+        # A failed collection is answered with HTTP 500, so Prometheus sets `up` to 0
+        try:
+            # The polled part is read first, so the live metrics about it are never older than it
+            polled, etag = b'', None
+            if snapshot is not None and version is not None and self.expositions is not None:
+                polled, etag = self.expositions.get((key, content_type), version, render_snapshot, gzipped)
+            elif snapshot is not None:
+                polled = render_snapshot()
+                if gzipped:
+                    polled = gzip.compress(polled, compresslevel=6)
+            live = encoder(registry() if callable(registry) else registry)
+            # Concatenated gzip members decompress to the concatenated expositions
+            body = polled + (gzip.compress(live, compresslevel=6) if gzipped else live)
+        except Exception as e:
+            return self._send(500, '{}\n'.format(e).encode())
+
+        if etag is None:
+            return self._send(200, body, content_type, headers)
+        headers.append(('ETag', etag))
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            for name, value in headers:
+                if name != 'Content-Encoding':
+                    self.send_header(name, value)
+            self.end_headers()
+            return
+        self._send(200, body, content_type, headers)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        sections = params.get('collect[]')
+        if url.path == '/probe':
+            if self.targets is None:
+                return self._send(404, b'Multi-target mode needs --config\n')
+            target = params.get('target', [None])[0]
+            if not target:
+                return self._send(400, b'Missing target parameter\n')
+            module = params.get('module', [None])[0]
+            try:
+                collector = self.targets.get(target, module)
+                check_sections(collector, sections)
+            except KeyError as e:
+                return self._send(400, '{}\n'.format(e.args[0]).encode())
+            if not isinstance(collector, SmartZonePoller):
+                return self._send_registry(lambda: StaticRegistry(self.targets.probe(target, module, sections)))
+            return self._send_registry(
+                lambda: StaticRegistry(self.targets.probe(target, module, sections, snapshot=False)),
+                ('probe', target, module, tuple(sorted(set(sections or ())))), collector.version,
+                lambda: StaticRegistry(list(collector.snapshot_families(sections))))
+        if url.path in ('/', '/metrics'):
+            polled = isinstance(self.collector, SmartZonePoller)
+            if sections is None and not polled:
+                return self._send_registry(self.registry)
+            if sections is None:
+                # The registry holds the poller without its snapshot, see PollerMetrics
+                return self._send_registry(self.registry, ('metrics',), self.collector.version,
+                                           lambda: StaticRegistry(list(self.collector.snapshot_families())))
+            if self.collector is None:
+                return self._send(400, b'collect[] needs a -t target, use /probe for configured targets\n')
+            try:
+                check_sections(self.collector, sections)
+            except KeyError as e:
+                return self._send(400, '{}\n'.format(e.args[0]).encode())
+            if not polled:
+                return self._send_registry(lambda: StaticRegistry(list(self.collector.collect(sections))))
+            return self._send_registry(lambda: StaticRegistry(list(self.collector.collect(sections, snapshot=False))),
+                                       ('metrics', tuple(sorted(set(sections)))), self.collector.version,
+                                       lambda: StaticRegistry(list(self.collector.snapshot_families(sections))))
+        return self._send(404, b'Not found\n')
+
+
+def start_http_server(port, targets=None, collector=None):
+    # Like prometheus_client.start_http_server, with the /probe endpoint added
+    handler = type('Handler', (SmartZoneHandler,), {'targets': targets, 'collector': collector,
+                                                    'expositions': ExpositionCache()})
+    server = ThreadingHTTPServer(('', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 
 # Function to parse command line arguments and pass them to the collector
@@ -685,12 +3092,15 @@ def parse_args():
     # Use add_argument() method to specify options
     # By default argparse will treat any arguments with flags (- or --) as optional
     # Rather than make these required (considered bad form), we can create another group for required options
-    required_named = parser.add_argument_group('required named arguments')
-    required_named.add_argument('-u', '--user', help='SmartZone API user', required=True)
-    required_named.add_argument('-p', '--password', help='SmartZone API password', required=True)
+    # Target arguments are only optional when the exporter serves configured targets on /probe
+    required_named = parser.add_argument_group('required named arguments (unless --config is given)')
+    required_named.add_argument('-u', '--user', help='SmartZone API user')
+    required_named.add_argument('-p', '--password', help='SmartZone API password')
     required_named.add_argument('-t', '--target',
-                                help='Target URL and port to access SmartZone, e.g. https://smartzone.example.com:8443',
-                                required=True)
+                                help='Target URL and port to access SmartZone, e.g. https://smartzone.example.com:8443')
+
+    # Config file of controllers and credentials served on /probe?target=...&module=...
+    parser.add_argument('--config', help='Multi-target config file, enables the /probe endpoint')
 
     # Add store_false action to store true/false values, and set a default of True
     parser.add_argument('--insecure', action='store_false', help='Allow insecure SSL connections to Smartzone')
@@ -699,20 +3109,221 @@ def parse_args():
     parser.add_argument('--port', type=int, default=9345,
                         help='Port on which to expose metrics and web interface (default=9345)')
 
+    # Renew the API session proactively instead of waiting for the controller to reject it
+    parser.add_argument('--session-ttl', type=int, default=0,
+                        help='Seconds after which the API session is renewed, 0 only renews on HTTP 401 (default=0)')
+
+    # Per-request timeout and retries of failed requests
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='Seconds before an API request is abandoned (default=30)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Number of times a request failing with a connection error, timeout or HTTP 429/5xx '
+                             'is retried (default=2)')
+    parser.add_argument('--retry-backoff', type=float, default=0.5,
+                        help='Seconds before the first retry, doubled for every further retry (default=0.5)')
+
+    # Pagination of list APIs
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Number of entities requested per page from list APIs (default=1000)')
+    parser.add_argument('--page-concurrency', type=int, default=4,
+                        help='Number of list pages fetched concurrently (default=4)')
+
+    # Source of the per-AP detail metrics
+    parser.add_argument('--ap-detail-mode', choices=AP_DETAIL_MODES, default='per-ap',
+                        help='Fetch AP details with one call per AP, in bulk from query/ap, or per AP only for APs '
+                             'that changed according to query/ap (default=per-ap)')
+    parser.add_argument('--ap-refresh-fraction', type=float, default=0.05,
+                        help='Share of unchanged APs refreshed anyway each cycle in incremental mode (default=0.05)')
+
+    # Collection engine and limits on the load put on the SmartZone API
+    parser.add_argument('--engine', choices=ENGINES, default='threads',
+                        help='Collect with worker threads, or fetch all endpoints concurrently with asyncio/aiohttp '
+                             '(default=threads)')
+    parser.add_argument('--max-concurrency', type=int, default=10,
+                        help='Maximum number of API requests in flight, AP worker threads for the threads engine '
+                             '(default=10)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Maximum API requests per second with the asyncio engine, 0 is unlimited (default=0)')
+    parser.add_argument('--rate-burst', type=int, default=10,
+                        help='Requests allowed in a burst above --rate-limit (default=10)')
+    parser.add_argument('--endpoint-rate-limit', action='append', default=[], metavar='ENDPOINT=RATE',
+                        help='Requests per second for one endpoint with the asyncio engine, '
+                             'e.g. aps/{mac}/operational/summary=50, can be repeated')
+
+    # Reuse responses of slow-changing endpoints across scrapes
+    parser.add_argument('--cache-ttl', action='append', default=[], metavar='ENDPOINT=SECONDS',
+                        help='Seconds to reuse responses of an endpoint, 0 disables caching, can be repeated '
+                             '(default={})'.format(','.join('{}={}'.format(endpoint, ttl) for endpoint, ttl
+                                                            in DEFAULT_CACHE_TTLS.items())))
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='Maximum number of cached responses (default=10000)')
+
+    # JSON parsing of API responses
+    parser.add_argument('--json-parser', choices=JSON_PARSERS, default='auto',
+                        help='Parse responses with orjson when installed (auto), orjson, the json module, or stream '
+                             'the client list with ijson to keep memory flat (default=auto)')
+
+    # Cardinality limits
+    parser.add_argument('--drop-labels', metavar='REGEX',
+                        help='Remove labels whose name matches, e.g. description|location|serial')
+    parser.add_argument('--allow-labels', metavar='REGEX', help='Keep only labels whose name matches')
+    parser.add_argument('--max-series', type=int, default=0,
+                        help='Maximum number of series exported per metric, 0 is unlimited (default=0)')
+    parser.add_argument('--ap-info', action='store_true',
+                        help='Export the string-only AP metrics as labels of one smartzone_ap_info series per AP')
+
+    # Per-second rates of the port and WLAN traffic counters, computed by the exporter
+    parser.add_argument('--rate-samples', type=int, default=0,
+                        help='Export per-second rates of the port and WLAN traffic counters over this many '
+                             'collections, 0 disables them (default=0)')
+
+    # Share collections between concurrent scrapes when polling on demand
+    parser.add_argument('--coalesce-window', type=float, default=0,
+                        help='Seconds a collection is reused for further scrapes after it finished, scrapes '
+                             'arriving while it is in flight always share it (default=0)')
+
+    # Alarms and events, read incrementally from the alert APIs
+    parser.add_argument('--alarm-index-size', type=int, default=10000,
+                        help='Maximum number of active alarms kept, the oldest are forgotten beyond that '
+                             '(default=10000)')
+    parser.add_argument('--alarm-resync', type=float, default=300,
+                        help='Seconds between re-reads of the alarms that are not cleared, which pick up acknowledged '
+                             'and cleared alarms (default=300)')
+
+    # Split the APs of large controllers across several exporter replicas
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='Number of exporter replicas the APs are split across, by a hash of their MAC '
+                             '(default=1)')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Shard of this replica, from 0 to --shard-count - 1. Only shard 0 collects the '
+                             'controller-wide sections (default=0)')
+
+    # Sections collected by default, scrapes can select a subset with collect[]
+    parser.add_argument('--sections', default=','.join(SECTIONS),
+                        help='Comma-separated sections to collect (default={})'.format(','.join(SECTIONS)))
+
+    # Poll in the background and serve the last snapshot, instead of calling the API on every scrape
+    parser.add_argument('--interval', type=int, default=0,
+                        help='Background polling interval in seconds, 0 polls on every scrape (default=0)')
+
+    # Keep the last snapshot on disk, so a restarted exporter has data to serve right away
+    parser.add_argument('--state-dir',
+                        help='Directory where the last snapshot of every target is saved after each poll and '
+                             'loaded from at startup, needs --interval')
+
+    # Push completed snapshots instead of waiting to be scraped
+    parser.add_argument('--push-url',
+                        help='Push every polled snapshot to this remote_write or OTLP/HTTP metrics URL, '
+                             'needs --interval')
+    parser.add_argument('--push-format', choices=sorted(PUSH_FORMATS), default='remote_write',
+                        help='Prometheus remote_write (needs python-snappy) or OTLP/HTTP JSON (default=remote_write)')
+    parser.add_argument('--push-job', default='smartzone',
+                        help='job label of pushed series, service.name with OTLP (default=smartzone)')
+    parser.add_argument('--push-header', action='append', default=[], metavar='NAME=VALUE',
+                        help='HTTP header sent with every push, e.g. Authorization=Bearer TOKEN, can be repeated')
+    parser.add_argument('--push-batch-size', type=int, default=5000,
+                        help='Maximum series per push request (default=5000)')
+    parser.add_argument('--push-queue-size', type=int, default=10,
+                        help='Snapshots kept while the push endpoint is unavailable, the oldest is dropped '
+                             'beyond that (default=10)')
+
     # Now that we've added the arguments, parse them and return the values as output
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.config is None and not (args.user and args.password and args.target):
+        parser.error('the following arguments are required: -u/--user, -p/--password, -t/--target')
+    try:
+        check_options(vars(args), lambda key: '--' + key.replace('_', '-'))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.state_dir is not None and args.interval <= 0:
+        parser.error('--state-dir needs --interval')
+    if args.state_dir is not None and not os.path.isdir(args.state_dir):
+        parser.error('--state-dir {} is not a directory'.format(args.state_dir))
+    if args.push_url is not None and args.interval <= 0:
+        parser.error('--push-url needs --interval')
+    if args.push_url is not None and args.push_format == 'remote_write' and snappy is None:
+        parser.error('--push-format remote_write requires the python-snappy package')
+    try:
+        args.push_header = dict(header.split('=', 1) for header in args.push_header)
+    except ValueError:
+        parser.error('--push-header expects NAME=VALUE')
+    try:
+        args.sections = parse_sections(args.sections)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        args.endpoint_rate_limit = parse_endpoint_values(args.endpoint_rate_limit)
+    except ValueError:
+        parser.error('--endpoint-rate-limit expects ENDPOINT=RATE')
+    try:
+        args.cache_ttl = dict(DEFAULT_CACHE_TTLS, **parse_endpoint_values(args.cache_ttl))
+    except ValueError:
+        parser.error('--cache-ttl expects ENDPOINT=SECONDS')
+    return args
 
 
 def main():
     try:
         args = parse_args()
         port = int(args.port)
-        REGISTRY.register(SmartZoneCollector(args.target, args.user, args.password, args.insecure))
+
+        # Collector options from the command line, also the defaults for --config modules
+        options = {'session_ttl': args.session_ttl, 'page_size': args.page_size,
+                   'page_concurrency': args.page_concurrency, 'ap_detail_mode': args.ap_detail_mode,
+                   'engine': args.engine, 'max_concurrency': args.max_concurrency, 'rate_limit': args.rate_limit,
+                   'rate_burst': args.rate_burst, 'endpoint_rate_limits': args.endpoint_rate_limit,
+                   'cache_ttls': args.cache_ttl, 'cache_size': args.cache_size,
+                   'ap_refresh_fraction': args.ap_refresh_fraction, 'json_parser': args.json_parser,
+                   'timeout': args.timeout, 'retries': args.retries, 'retry_backoff': args.retry_backoff,
+                   'sections': args.sections, 'drop_labels': args.drop_labels, 'allow_labels': args.allow_labels,
+                   'max_series': args.max_series, 'ap_info': args.ap_info, 'rate_samples': args.rate_samples,
+                   'coalesce_window': args.coalesce_window, 'shard_index': args.shard_index,
+                   'shard_count': args.shard_count, 'alarm_index_size': args.alarm_index_size,
+                   'alarm_resync': args.alarm_resync}
+        # One bounded worker pool for every target
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.max_concurrency)
+
+        pusher = None
+        if args.push_url is not None:
+            pusher = SmartZonePusher(args.push_url, args.push_format, args.push_job, args.push_header,
+                                     args.push_batch_size, args.push_queue_size, args.timeout, args.retry_backoff)
+            pusher.start()
+            REGISTRY.register(pusher)
+
+        targets = None
+        if args.config is not None:
+            try:
+                modules, configured = load_config(args.config, dict(options, insecure=args.insecure))
+            except (ValueError, configparser.Error) as e:
+                print('ERROR: {}'.format(e))
+                exit(1)
+            modules.setdefault('default', dict(options, insecure=args.insecure))
+            targets = SmartZoneTargets(modules, configured, executor, args.interval, pusher, args.state_dir)
+            if pusher is not None:
+                # Nothing may ever probe the targets, so they are all polled and pushed from the start
+                for name in configured:
+                    targets.get(name)
+
+        collector = None
+        if args.target is not None:
+            collector = SmartZoneCollector(args.target, args.user, args.password, args.insecure,
+                                           executor=executor, **options)
+            if args.interval > 0:
+                # Scrapes are answered from the poller snapshot, the collector only runs in the poller thread
+                collector = SmartZonePoller(collector, args.interval, pusher, state_dir=args.state_dir)
+                collector.start()
+                REGISTRY.register(PollerMetrics(collector))
+            else:
+                REGISTRY.register(collector)
+
         # Start HTTP server on specified port
-        start_http_server(port)
-        if args.insecure == False:
-            print('WARNING: Connection to {} may not be secure.'.format(args.target))
-        print("Polling {}. Listening on ::{}".format(args.target, port))
+        start_http_server(port, targets, collector)
+        if args.target is not None:
+            if args.insecure == False:
+                print('WARNING: Connection to {} may not be secure.'.format(args.target))
+            print("Polling {}. Listening on ::{}".format(args.target, port))
+        if targets is not None:
+            print("Serving {} configured targets on /probe. Listening on ::{}".format(len(configured), port))
         while True:
             time.sleep(1)
     except KeyboardInterrupt: